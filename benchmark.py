@@ -0,0 +1,558 @@
+"""Offline benchmarks for the music bot.
+
+Drives the real slash command handlers from player.py against a deterministic
+fake YoutubeDL and a fake voice client, so performance changes can be measured
+without Discord or YouTube:
+
+    python benchmark.py                      # fake extractor + fake audio
+    python benchmark.py --latency 0.5        # slower fake extractions
+    python benchmark.py --ffmpeg             # real ffmpeg against local files over HTTP
+"""
+import argparse
+import asyncio
+import functools
+import http.server
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, urlparse
+
+FRAME_SECONDS = 0.02
+
+
+# 📊 Helpers for reporting
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def report(name, latencies, total_time=None, items=None):
+    """Print latency percentiles (ms) and optional throughput for one scenario"""
+    line = (f"{name:<32} n={len(latencies):<6} "
+            f"p50={percentile(latencies, 0.5) * 1000:8.2f}ms "
+            f"p90={percentile(latencies, 0.9) * 1000:8.2f}ms "
+            f"p99={percentile(latencies, 0.99) * 1000:8.2f}ms "
+            f"max={max(latencies, default=float('nan')) * 1000:8.2f}ms")
+    if total_time and items:
+        line += f"  {items / total_time:10.1f}/s"
+    print(line)
+
+
+# 🎭 Fake yt-dlp
+class FakeYoutubeDL:
+    """Stands in for yt_dlp.YoutubeDL with configurable, deterministic latency"""
+
+    latency = 0.2
+    jitter = 0.05
+    duration = 2
+    stream_base = 'https://rr1---sn-fake.googlevideo.com/videoplayback'
+    seed = 1
+
+    def __init__(self, params=None):
+        self.params = params or {}
+        self.random = random.Random(self.seed)
+
+    def _sleep(self):
+        time.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+
+    def _video(self, video_id):
+        return {
+            'id': video_id,
+            'title': f"Benchmark track {video_id}",
+            'url': f"{self.stream_base}/{video_id}?expire={int(time.time()) + 21600}",
+            'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+            'duration': self.duration,
+            'acodec': 'opus',
+            'ext': 'webm',
+        }
+
+    def extract_info(self, url, download=False):
+        self._sleep()
+        if url.startswith('ytsearch:'):
+            video_id = f"s{abs(hash(url)) % 10 ** 10:010d}"
+            return {'entries': [self._video(video_id)]}
+        query = parse_qs(urlparse(url).query)
+        if 'list' in query:
+            count = int(query['list'][0].lstrip('BENCH') or 100)
+            return {
+                'title': 'Benchmark playlist',
+                'entries': [
+                    {'id': f"p{index:010d}", 'title': f"Playlist track {index}", 'duration': self.duration}
+                    for index in range(count)
+                ],
+            }
+        return self._video(query.get('v', ['x0000000000'])[0])
+
+
+# 🔈 Fake audio pipeline
+class FakeOpusAudio:
+    """Stands in for FFmpegOpusAudio: a fixed number of silent Opus frames after a spawn delay"""
+
+    spawn_latency = 0.05
+
+    def __init__(self, source, *, bitrate=None, codec=None, before_options=None, options=None, **kwargs):
+        time.sleep(self.spawn_latency)
+        duration = FakeYoutubeDL.duration
+        self.frames_left = int(duration / FRAME_SECONDS)
+
+    def read(self):
+        if self.frames_left <= 0:
+            return b''
+        self.frames_left -= 1
+        return b'\xf8\xff\xfe'  # Opus silence frame
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.frames_left = 0
+
+
+class FakeVoiceClient:
+    """Mimics discord.VoiceClient.play(): a thread pulls 20 ms frames and calls `after`"""
+
+    def __init__(self, channel, realtime):
+        self.channel = channel
+        self.realtime = realtime
+        self._playing = threading.Event()
+        self._paused = False
+        self._stop = threading.Event()
+        self._thread = None
+        self.play_calls = []  # perf_counter() of every play()
+        self.frames_sent = 0
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return self._playing.is_set() and not self._paused
+
+    def is_paused(self):
+        return self._playing.is_set() and self._paused
+
+    def play(self, source, *, after=None):
+        if self._playing.is_set():
+            raise RuntimeError('Already playing audio.')
+        self.play_calls.append(time.perf_counter())
+        self._stop.clear()
+        self._playing.set()
+        self._thread = threading.Thread(target=self._run, args=(source, after), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after):
+        error = None
+        next_frame = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                if self._paused:
+                    time.sleep(FRAME_SECONDS)
+                    continue
+                data = source.read()
+                if not data:
+                    break
+                self.frames_sent += 1
+                if self.realtime:
+                    next_frame += FRAME_SECONDS
+                    time.sleep(max(0.0, next_frame - time.perf_counter()))
+        except Exception as e:
+            error = e
+        finally:
+            self._playing.clear()
+            if after is not None:
+                after(error)
+            source.cleanup()
+
+    def stop(self):
+        self._stop.set()
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+
+
+# 🧪 Fake Discord objects
+class FakeMessage:
+    def __init__(self, channel, message_id):
+        self.channel = channel
+        self.id = message_id
+
+    async def edit(self, **kwargs):
+        return self
+
+
+class FakeTextChannel:
+    id = 1
+
+    def __init__(self):
+        self.sent = 0
+        self.last_message_id = None
+
+    async def send(self, *args, **kwargs):
+        self.sent += 1
+        self.last_message_id = self.sent
+        return FakeMessage(self, self.sent)
+
+
+class FakeVoiceChannel:
+    id = 2
+    bitrate = 64000
+    name = 'Benchmark voice'
+
+    def __init__(self, realtime):
+        self.realtime = realtime
+        self.members = []
+        self.voice_client = None
+
+    async def connect(self, **kwargs):
+        self.voice_client = FakeVoiceClient(self, self.realtime)
+        return self.voice_client
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"Benchmark guild {guild_id}"
+
+
+class FakeResponse:
+    def __init__(self):
+        self.done = False
+
+    async def defer(self, **kwargs):
+        self.done = True
+
+    async def send_message(self, *args, **kwargs):
+        self.done = True
+
+    def is_done(self):
+        return self.done
+
+
+class FakeFollowup:
+    async def send(self, *args, **kwargs):
+        return None
+
+
+class FakeUser:
+    def __init__(self, voice_channel):
+        self.voice = type('VoiceState', (), {'channel': voice_channel})()
+
+
+class FakeInteraction:
+    """Just enough of discord.Interaction for the command handlers"""
+
+    def __init__(self, guild, voice_channel, text_channel):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = FakeUser(voice_channel)
+        self.channel = text_channel
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+        self.created_at = datetime.now(timezone.utc)
+
+    async def original_response(self):
+        return FakeMessage(self.channel, 0)
+
+
+class FakeGuildContext:
+    """A guild with a voice channel and a text channel, producing fresh interactions"""
+
+    def __init__(self, guild_id, realtime):
+        self.guild = FakeGuild(guild_id)
+        self.voice_channel = FakeVoiceChannel(realtime)
+        self.text_channel = FakeTextChannel()
+
+    def interaction(self):
+        return FakeInteraction(self.guild, self.voice_channel, self.text_channel)
+
+    @property
+    def voice_client(self):
+        return self.voice_channel.voice_client
+
+
+# 🧹 Between scenarios
+def reset_player(player):
+    """Forget every guild, queue and cached stream"""
+    for guild_id in list(player.voice_clients):
+        player.voice_clients[guild_id].stop()
+        player.release_playback_state(guild_id)
+    player.voice_clients.clear()
+    player.song_queues.clear()
+    player.track_gaps.clear()
+    with player.stream_cache.lock:
+        player.stream_cache.entries.clear()
+
+
+async def wait_for(condition, timeout=60.0):
+    """Poll until a condition is true or the timeout expires"""
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError('benchmark condition not reached')
+        await asyncio.sleep(0.005)
+
+
+# 🏁 Scenarios
+async def bench_play_and_search(player, args):
+    """/play and /search latency for cold (extracted) and warm (cached) videos"""
+    reset_player(player)
+    context = FakeGuildContext(1, realtime=True)
+    for label in ('cold', 'warm'):
+        latencies = []
+        for index in range(args.requests):
+            started = time.perf_counter()
+            await player.play_song.callback(context.interaction(),
+                                            f"https://www.youtube.com/watch?v=c{index:010d}")
+            latencies.append(time.perf_counter() - started)
+        report(f"/play ({label})", latencies)
+
+    latencies = []
+    for index in range(args.requests):
+        started = time.perf_counter()
+        await player.search_song.callback(context.interaction(), f"benchmark query {index}")
+        latencies.append(time.perf_counter() - started)
+    report("/search", latencies)
+
+
+async def bench_playlist_ingest(player, args):
+    """/list: command latency, time to first audio and ahead-of-time resolution throughput"""
+    reset_player(player)
+    context = FakeGuildContext(2, realtime=True)
+    started = time.perf_counter()
+    await player.add_playlist.callback(
+        context.interaction(), f"https://www.youtube.com/playlist?list=BENCH{args.playlist_size}")
+    command_time = time.perf_counter() - started
+    queued = len(player.song_queues[context.guild.id])
+    # Playback is started by the guild's player task, possibly after the command returned
+    await wait_for(lambda: context.voice_client.play_calls)
+    first_audio = context.voice_client.play_calls[0] - started
+    report("/list command", [command_time], command_time, queued)
+    report("/list time to first audio", [first_audio])
+
+    # Resolve the whole queue through the scheduler to measure extraction throughput
+    tracks = list(player.song_queues[context.guild.id])
+    latencies = []
+
+    async def resolve(track):
+        track_started = time.perf_counter()
+        await player.resolve_track(track, player.bot.loop, context.guild.id)
+        latencies.append(time.perf_counter() - track_started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(resolve(track) for track in tracks))
+    report(f"resolve (cap {player.extraction_scheduler.concurrency})", latencies,
+           time.perf_counter() - started, len(tracks))
+
+    # A second guild's /play while the first guild's backlog is still being worked on
+    reset_player(player)
+    busy = FakeGuildContext(3, realtime=True)
+    other = FakeGuildContext(4, realtime=True)
+    await player.add_playlist.callback(
+        busy.interaction(), f"https://www.youtube.com/playlist?list=BENCH{args.playlist_size}")
+    backlog = [player.bot.loop.create_task(player.resolve_track(track, player.bot.loop, busy.guild.id))
+               for track in list(player.song_queues[busy.guild.id])]
+    started = time.perf_counter()
+    await player.play_song.callback(other.interaction(), "https://www.youtube.com/watch?v=f0000000000")
+    report("/play during other guild ingest", [time.perf_counter() - started])
+    await asyncio.gather(*backlog)
+
+
+async def bench_queue_operations(player, args):
+    """SongQueue primitives and the /remove and /queue handlers on a large queue"""
+    reset_player(player)
+    size = args.queue_size
+    tracks = [player.Track(f"q{index:010d}", f"Queued track {index}",
+                           webpage_url=f"https://www.youtube.com/watch?v=q{index:010d}", duration=180)
+              for index in range(size)]
+    queue = player.SongQueue()
+
+    started = time.perf_counter()
+    queue.extend(tracks)
+    elapsed = time.perf_counter() - started
+    report("SongQueue.extend", [elapsed], elapsed, size)
+
+    rng = random.Random(2)
+    operations = {'append+popleft': [], 'remove_range': [], 'move': [], 'slice page': []}
+    for _ in range(args.requests):
+        started = time.perf_counter()
+        queue.append(queue.popleft())
+        operations['append+popleft'].append(time.perf_counter() - started)
+
+        start = rng.randrange(len(queue) - 10)
+        started = time.perf_counter()
+        removed = queue.remove_range(start, 10)
+        operations['remove_range'].append(time.perf_counter() - started)
+        queue.extend(removed)
+
+        started = time.perf_counter()
+        queue.move(rng.randrange(len(queue)), rng.randrange(len(queue)))
+        operations['move'].append(time.perf_counter() - started)
+
+        start = rng.randrange(len(queue) - 10)
+        started = time.perf_counter()
+        queue.slice(start, start + 10)
+        operations['slice page'].append(time.perf_counter() - started)
+    for name, latencies in operations.items():
+        report(f"SongQueue {name}", latencies)
+
+    started = time.perf_counter()
+    queue.shuffle()
+    report("SongQueue.shuffle", [time.perf_counter() - started])
+
+    # Handlers, with a connected (idle) fake voice client
+    context = FakeGuildContext(5, realtime=True)
+    player.voice_clients[context.guild.id] = await context.voice_channel.connect()
+    player.song_queues[context.guild.id] = queue
+    for name, call in (
+            ('/queue', lambda: player.show_queue.callback(context.interaction())),
+            ('/remove', lambda: player.remove_from_queue.callback(
+                context.interaction(), rng.randrange(1, len(queue) - 5), 5))):
+        latencies = []
+        for _ in range(args.requests):
+            started = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - started)
+        report(f"{name} ({len(queue)} tracks)", latencies)
+
+
+async def bench_handoff(player, args, label):
+    """Silence between consecutive tracks, as measured by the player itself"""
+    reset_player(player)
+    context = FakeGuildContext(6, realtime=True)
+    await player.add_playlist.callback(
+        context.interaction(), f"https://www.youtube.com/playlist?list=BENCH{args.tracks}")
+    guild_id = context.guild.id
+    await wait_for(lambda: len(context.voice_client.play_calls) >= args.tracks
+                   and not context.voice_client.is_playing(),
+                   timeout=args.tracks * (FakeYoutubeDL.duration + 10))
+    report(f"track handoff gap ({label})", list(player.track_gaps.get(guild_id, ())))
+
+
+async def bench_real_ffmpeg(player, args, base_url):
+    """Real ffmpeg: time from spawning the process to its first Opus frame"""
+    reset_player(player)
+    first_frame = []
+    encoding = player.encoding_for(None)
+    for index in range(args.requests):
+        track = player.Track(f"local{index % 3:06d}", 'Local file',
+                             url=f"{base_url}/track{index % 3}.webm", duration=FakeYoutubeDL.duration,
+                             codec='opus')
+        started = time.perf_counter()
+        source = await player.bot.loop.run_in_executor(None, player.open_audio_source, track, 0, encoding)
+        first_frame.append(time.perf_counter() - started)
+        source.cleanup()
+    report("ffmpeg open + first frame", first_frame)
+
+
+def serve_local_audio(directory, count, duration):
+    """Generate Opus/WebM test tones and serve them on a localhost HTTP server"""
+    for index in range(count):
+        subprocess.run(
+            ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-f', 'lavfi',
+             '-i', f'sine=frequency={440 + index * 110}:duration={duration}',
+             '-ac', '2', '-ar', '48000', '-c:a', 'libopus', '-b:a', '96k',
+             os.path.join(directory, f'track{index}.webm')],
+            check=True)
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=directory)
+    handler.log_message = lambda *args: None
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+async def main(args):
+    import extraction
+    import player
+
+    player.bot.loop = asyncio.get_running_loop()
+    extraction.yt_dlp.YoutubeDL = FakeYoutubeDL
+    FakeYoutubeDL.latency = args.latency
+    FakeYoutubeDL.jitter = args.latency / 4
+    FakeYoutubeDL.duration = args.track_seconds
+    FakeOpusAudio.spawn_latency = args.spawn_latency
+
+    print(f"Fake extraction latency {args.latency * 1000:.0f} ms, "
+          f"extraction cap {player.extraction_scheduler.concurrency} "
+          f"({player.extraction_scheduler.backend} backend)\n")
+
+    real_ffmpeg_audio = player.FFmpegOpusAudio
+    player.FFmpegOpusAudio = FakeOpusAudio
+    await bench_play_and_search(player, args)
+    await bench_playlist_ingest(player, args)
+    await bench_queue_operations(player, args)
+    await bench_handoff(player, args, 'prefetch')
+
+    # Same handoff without the prefetch stage, for comparison
+    schedule_prefetch = player.schedule_prefetch
+    player.schedule_prefetch = lambda guild_id, immediate=False: None
+    await bench_handoff(player, args, 'no prefetch')
+    player.schedule_prefetch = schedule_prefetch
+
+    if args.ffmpeg:
+        if not shutil.which('ffmpeg'):
+            print("\nffmpeg not found on PATH - skipping real ffmpeg benchmarks")
+            return
+        player.FFmpegOpusAudio = real_ffmpeg_audio
+        with tempfile.TemporaryDirectory() as directory:
+            server, base_url = serve_local_audio(directory, 3, args.track_seconds)
+            try:
+                await bench_real_ffmpeg(player, args, base_url)
+
+                # Point every fake video at one of the local files
+                original_video = FakeYoutubeDL._video
+
+                def local_video(self, video_id):
+                    info = original_video(self, video_id)
+                    info['url'] = f"{base_url}/track{int(video_id[1:]) % 3}.webm"
+                    return info
+
+                FakeYoutubeDL._video = local_video
+                await bench_handoff(player, args, 'real ffmpeg')
+                FakeYoutubeDL._video = original_video
+            finally:
+                server.shutdown()
+    reset_player(player)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the music bot")
+    parser.add_argument('--latency', type=float, default=0.2, help="Fake extraction latency in seconds")
+    parser.add_argument('--spawn-latency', type=float, default=0.05, help="Fake audio source startup in seconds")
+    parser.add_argument('--concurrency', type=int, help="Override EXTRACT_CONCURRENCY")
+    parser.add_argument('--requests', type=int, default=50, help="Samples per latency scenario")
+    parser.add_argument('--playlist-size', type=int, default=200, help="Entries in the fake /list playlist")
+    parser.add_argument('--queue-size', type=int, default=10000, help="Tracks in the queue operation benchmark")
+    parser.add_argument('--tracks', type=int, default=5, help="Tracks played in the handoff benchmark")
+    parser.add_argument('--track-seconds', type=float, default=2.0, help="Length of every fake track")
+    parser.add_argument('--ffmpeg', action='store_true', help="Also benchmark real ffmpeg against local files")
+    args = parser.parse_args()
+
+    # Keep the benchmark away from real state and background analysis
+    state_dir = tempfile.mkdtemp(prefix='musicbot-bench-')
+    os.environ['BOT_DB_PATH'] = os.path.join(state_dir, 'bench.db')
+    os.environ['PERSIST_STATE'] = '0'
+    os.environ['STREAM_CACHE_PERSIST'] = '0'
+    os.environ['SEARCH_HISTORY_PERSIST'] = '0'
+    os.environ['LOUDNESS_ANALYSIS'] = '0'
+    os.environ.pop('AUDIO_CACHE_DIR', None)
+    if args.concurrency:
+        os.environ['EXTRACT_CONCURRENCY'] = str(args.concurrency)
+
+    try:
+        asyncio.run(main(args))
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
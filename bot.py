@@ -0,0 +1,8 @@
+# Entry point of the bot. Spawned extraction workers re-import the main module, so this one only
+# loads player.py (which opens the database and caches on import) when it is run as a script
+if __name__ == '__main__':
+    import asyncio
+
+    import player
+
+    asyncio.run(player.start_bot())
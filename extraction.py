@@ -0,0 +1,182 @@
+# yt-dlp extraction - kept free of import side effects, so worker processes can load it on its own
+import os
+import re
+import threading
+
+import yt_dlp
+
+# Set by init_extract_worker - the bot adjusts the format to its playback mode
+ytdl_options = {}
+
+
+def slim_info(info):
+    """Keep only the fields playback needs from a yt-dlp info dict"""
+    return {
+        'id': info.get('id'),
+        'title': info.get('title'),
+        'url': info.get('url'),
+        'duration': info.get('duration'),
+        'webpage_url': info.get('webpage_url'),
+        'acodec': info.get('acodec'),
+        'ext': info.get('ext'),
+    }
+
+
+# Helper function to print format information
+def print_format_info(info_dict):
+    """Print detailed format information from yt-dlp results"""
+    # Only run if debug mode is enabled
+    if not os.getenv('DEBUG'):
+        return
+        
+    # Check if info_dict is None
+    if info_dict is None:
+        print("No info dictionary provided to print_format_info")
+        return
+        
+    # Print available info keys
+    print(f"Info keys: {list(info_dict.keys())}")
+    
+    # Print all available formats
+    if 'formats' in info_dict:
+        print("\nALL AVAILABLE FORMATS:")
+        for fmt in info_dict['formats']:
+            print(f"Format ID: {fmt.get('format_id')} - Ext: {fmt.get('ext')} - "
+                  f"Audio: {fmt.get('acodec')} - Video: {fmt.get('vcodec')} - "
+                  f"ABR: {fmt.get('abr')} - TBR: {fmt.get('tbr')}")
+    
+    # Debug: Look for best format - what yt-dlp actually selected
+    if 'requested_formats' in info_dict:
+        print("\nSELECTED FORMATS:")
+        for fmt in info_dict['requested_formats']:
+            format_id = fmt.get('format_id', 'unknown')
+            ext = fmt.get('ext', 'unknown')
+            acodec = fmt.get('acodec', 'none')
+            abr = fmt.get('abr', fmt.get('tbr', 'unknown'))
+            
+            print(f"Selected format: {format_id} ({ext})")
+            print(f"Audio codec: {acodec}, Bitrate: {abr} kbps")
+    elif 'format_id' in info_dict:
+        # Single format selected
+        print("\nSINGLE SELECTED FORMAT:")
+        print(f"Format ID: {info_dict.get('format_id')} - Ext: {info_dict.get('ext')}")
+        print(f"Audio codec: {info_dict.get('acodec')}, Bitrate: {info_dict.get('abr', info_dict.get('tbr', 'unknown'))} kbps")
+    else:
+        print("No format information available in the info")
+        # If we're here but have a URL, we probably have a direct stream URL
+        if 'url' in info_dict:
+            print(f"Direct URL found: {info_dict['url'][:50]}... (truncated)")
+            if 'ext' in info_dict:
+                print(f"Extension: {info_dict.get('ext')}")
+
+
+# Every extraction thread (or worker process) gets its own YoutubeDL instance
+_ytdl_local = threading.local()
+
+
+def get_ytdl():
+    """Return the YoutubeDL instance owned by the current thread"""
+    ytdl = getattr(_ytdl_local, 'ytdl', None)
+    if ytdl is None:
+        ytdl = _ytdl_local.ytdl = yt_dlp.YoutubeDL(ytdl_options)
+    return ytdl
+
+
+def init_extract_worker(options):
+    """Take the bot's yt-dlp options and warm up the worker's YoutubeDL instance"""
+    global ytdl_options
+    ytdl_options = options
+    get_ytdl()
+
+
+# yt-dlp error messages that mean YouTube is throttling us, or that one video can't be played
+THROTTLE_MARKERS = ('http error 429', 'too many requests', 'not a bot', 'rate-limited', 'rate limited')
+UNAVAILABLE_MARKERS = ('video unavailable', 'private video', 'has been removed', 'no longer available',
+                       'not available in your country', 'members-only', 'join this channel',
+                       'confirm your age', 'account associated with this video has been terminated',
+                       'copyright', 'does not exist')
+
+
+class ExtractionError(Exception):
+    """An extraction failed - kind is 'throttled', 'unavailable', 'error' or 'blocked' (by the circuit breaker)"""
+
+    def __init__(self, kind, message):
+        super().__init__(kind, message)  # Both in args, so it survives the trip back from a worker process
+        self.kind = kind
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+    @property
+    def reason(self):
+        """The part of the message worth showing to users"""
+        message = re.sub(r'^ERROR:\s*(\[[^\]]+\]\s*[\w-]+:\s*)?', '', self.message)
+        return message.split('. ')[0].strip().rstrip('.')[:150]
+
+    @classmethod
+    def from_exception(cls, e):
+        message = str(e)
+        lowered = message.lower()
+        if any(marker in lowered for marker in THROTTLE_MARKERS):
+            return cls('throttled', message)
+        if any(marker in lowered for marker in UNAVAILABLE_MARKERS):
+            return cls('unavailable', message)
+        return cls('error', message)
+
+
+def run_extraction(url):
+    """Extract a video (or the first search result) and return only the fields we need"""
+    try:
+        info = get_ytdl().extract_info(url, download=False)
+
+        # Check if this is a search result or playlist
+        if 'entries' in info:
+            # Get the first entry for searches (None when nothing was found)
+            if not info['entries']:
+                return None
+            entry = info['entries'][0]
+            if os.getenv('DEBUG'):  # Only print in debug mode
+                print(f"Entry keys: {list(entry.keys())}")
+                # Print format information if available
+                if 'formats' in entry:
+                    print_format_info(entry)
+            return slim_info(entry)
+        else:
+            # Direct URL
+            if os.getenv('DEBUG'):  # Only print in debug mode
+                print_format_info(info)
+            return slim_info(info)
+
+    except Exception as e:
+        raise ExtractionError.from_exception(e) from None
+
+
+def run_playlist_extraction(playlist_url):
+    """List the entries of a playlist without extracting the individual videos"""
+    # Configure ytdl to extract playlist
+    playlist_options = ytdl_options.copy()
+    playlist_options['noplaylist'] = False  # Enable playlist processing
+    playlist_options['extract_flat'] = 'in_playlist'  # Don't extract individual videos yet
+    playlist_ytdl = yt_dlp.YoutubeDL(playlist_options)
+
+    # Get playlist info
+    try:
+        playlist_info = playlist_ytdl.extract_info(playlist_url, download=False)
+    except Exception as e:
+        raise ExtractionError.from_exception(e) from None
+    if not playlist_info:
+        return None
+    if os.getenv('DEBUG'):
+        print(f"Playlist info keys: {list(playlist_info.keys())}")
+    # Don't try to print format info for the playlist itself - it won't have any
+
+    if 'entries' not in playlist_info:
+        return {'title': playlist_info.get('title'), 'entries': None}
+    return {
+        'title': playlist_info.get('title'),
+        'entries': [
+            {'id': entry.get('id'), 'title': entry.get('title'), 'duration': entry.get('duration')}
+            for entry in playlist_info['entries'] if entry
+        ],
+    }
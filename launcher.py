@@ -0,0 +1,143 @@
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+DEFAULT_PROCESSES = int(os.getenv('SHARD_PROCESSES', '2'))
+CONTROL_PORT_BASE = int(os.getenv('CONTROL_PORT_BASE', '8790'))
+METRICS_PORT_BASE = int(os.getenv('METRICS_PORT_BASE', '0'))  # 0 disables metrics in the shard processes
+RESTART_DELAY = 5  # Seconds before restarting a process that exited, doubled while it keeps crashing
+HEALTHY_UPTIME = 600  # A process that ran this long before exiting starts again from RESTART_DELAY
+
+
+# Split the shards into one contiguous group per process
+def assign_shards(shard_count, processes):
+    """Return the shard IDs each process should run"""
+    groups = [[] for _ in range(processes)]
+    for shard_id in range(shard_count):
+        groups[shard_id * processes // shard_count].append(shard_id)
+    return groups
+
+
+def start_process(index, shard_ids, shard_count):
+    """Start one bot process for a group of shards"""
+    env = dict(os.environ)
+    env['SHARD_COUNT'] = str(shard_count)
+    env['SHARD_IDS'] = ','.join(str(shard_id) for shard_id in shard_ids)
+    env['CONTROL_PORT'] = str(CONTROL_PORT_BASE + index)
+    # A METRICS_PORT inherited from the launcher would make every process but one fail to bind
+    env['METRICS_PORT'] = str(METRICS_PORT_BASE + index) if METRICS_PORT_BASE else '0'
+    metrics = f", metrics port {env['METRICS_PORT']}" if METRICS_PORT_BASE else ""
+    print(f"▶️ Starting process {index} for shards {env['SHARD_IDS']} "
+          f"(control port {env['CONTROL_PORT']}{metrics})")
+    return subprocess.Popen([sys.executable, BOT_SCRIPT], env=env)
+
+
+# 🚀 Run and supervise the shard processes
+def run(processes, shard_count):
+    """Start every shard process and restart any that exit"""
+    shard_count = max(shard_count or processes, processes)
+    groups = assign_shards(shard_count, processes)
+    children = [start_process(index, group, shard_count) for index, group in enumerate(groups)]
+    started_at = [time.monotonic()] * processes
+    restart_delays = [RESTART_DELAY] * processes
+    restart_at = [None] * processes  # When an exited process is due to start again
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        while not stopping:
+            time.sleep(1)
+            for index, child in enumerate(children):
+                if stopping:
+                    break
+                if child.poll() is None:
+                    continue
+                now = time.monotonic()
+                if restart_at[index] is None:
+                    # Back off on processes that keep crashing (e.g. login rate limits)
+                    if now - started_at[index] >= HEALTHY_UPTIME:
+                        restart_delays[index] = RESTART_DELAY
+                    print(f"⚠️ Process {index} exited with code {child.returncode}, "
+                          f"restarting in {restart_delays[index]}s")
+                    restart_at[index] = now + restart_delays[index]
+                    restart_delays[index] = min(restart_delays[index] * 2, 300)
+                elif now >= restart_at[index]:
+                    restart_at[index] = None
+                    children[index] = start_process(index, groups[index], shard_count)
+                    started_at[index] = time.monotonic()
+    finally:
+        for child in children:
+            if child.poll() is None:
+                child.terminate()
+        for child in children:
+            try:
+                child.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                child.kill()
+
+
+def query_process(port, command='status'):
+    """Send one command to a bot process over its control channel"""
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as connection:
+        connection.sendall(command.encode() + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data)
+
+
+# 📊 Aggregate the status of every shard process
+def show_status(processes):
+    """Print per-process and combined status"""
+    totals = {'guilds': 0, 'voice_clients': 0, 'playing': 0, 'queued_tracks': 0,
+              'extractions_running': 0, 'extractions_waiting': 0}
+    for index in range(processes):
+        port = CONTROL_PORT_BASE + index
+        try:
+            status = query_process(port)
+        except (OSError, ValueError) as e:
+            print(f"Process {index} (port {port}): unreachable ({e})")
+            continue
+        print(f"Process {index} (pid {status['pid']}, shards {status['shard_ids']}): "
+              f"{status['guilds']} guilds, {status['voice_clients']} voice clients, "
+              f"{status['queued_tracks']} queued tracks, latency {status['latency_ms']} ms")
+        if status.get('extraction_breaker', 'closed') != 'closed':
+            print(f"  Extraction circuit breaker {status['extraction_breaker']} "
+                  f"(limit {status['extraction_limit']})")
+        for key in totals:
+            totals[key] += status.get(key) or 0
+    print("Total: " + ", ".join(f"{key.replace('_', ' ')} {value}" for key, value in totals.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the music bot as several shard processes")
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'status'])
+    parser.add_argument('--processes', type=int, default=DEFAULT_PROCESSES,
+                        help="Number of bot processes (default: SHARD_PROCESSES or 2)")
+    parser.add_argument('--shards', type=int, default=int(os.getenv('SHARD_COUNT', '0')),
+                        help="Total number of shards (default: one per process)")
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        show_status(args.processes)
+    else:
+        run(args.processes, args.shards)
@@ -1,22 +1,77 @@
 import discord
-import yt_dlp
 import os
 import asyncio
 import time
+import re
+import random
+import math
+import shlex
+import subprocess
+import json
+import hashlib
+import heapq
+import bisect
+import sqlite3
+import ctypes
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from itertools import islice
+from urllib.parse import urlparse, parse_qs
 from discord.ext import commands
 from discord import FFmpegOpusAudio
+from discord.oggparse import OggStream
 from dotenv import load_dotenv
 from discord.app_commands.transformers import Range
 from discord import app_commands
+from extraction import (ExtractionError, init_extract_worker, run_extraction,
+                        run_playlist_extraction, slim_info)
+
+try:
+  import av  # Optional - only needed for AUDIO_BACKEND=pyav
+except ImportError:
+  av = None
 
 load_dotenv()
 
 TOKEN = os.getenv('discord_token')
 
+
+# Helper function to read boolean flags from the environment
+def env_flag(name, default=False):
+    """Return True if the environment variable is set to a truthy value"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# Sharding - usually set by launcher.py, which runs one process per group of shards
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0')) or None
+SHARD_IDS = [int(shard) for shard in os.getenv('SHARD_IDS', '').split(',') if shard.strip()] or None
+AUTO_SHARD = env_flag('AUTO_SHARD')
+
+# Seconds to wait between per-server command syncs
+COMMAND_SYNC_PACING = float(os.getenv('COMMAND_SYNC_PACING', '1.0'))
+
+# Local control channel (status requests from launcher.py), disabled when 0
+CONTROL_PORT = int(os.getenv('CONTROL_PORT', '0'))
+
+# Prometheus-style metrics endpoint, disabled when 0
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
 # Set up the bot
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents)
+if SHARD_COUNT or AUTO_SHARD:
+  bot = commands.AutoShardedBot(command_prefix='!', intents=intents,
+                                shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+  bot = commands.Bot(command_prefix='!', intents=intents)
 
 # Create voice client dictionary and song queue (per server)
 voice_clients = {}
@@ -29,14 +84,118 @@ yt_dl_options = {
     'verbose': False,  # Disable verbose output in production - change to True for debugging
     'dump_single_json': False  # Don't enable full JSON dump as it breaks the download
 }
-ytdl = yt_dlp.YoutubeDL(yt_dl_options)
 
 # Set up ffmpeg options for audio filtering
 ffmpeg_options = {
     'before_options':
     '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-    'options': '-vn -filter:a "loudnorm=I=-16:TP=-1.5:LRA=12" -b:a 320k'
+    'options': '-vn'  # Bitrate and complexity come from the guild's encoding profile
+}
+
+# Loudness normalization target (the filter is added per track, see loudness_filter)
+LOUDNESS_TARGET = -16.0
+LOUDNESS_TRUE_PEAK = -1.5
+LOUDNORM_FILTER = f'loudnorm=I={LOUDNESS_TARGET:g}:TP={LOUDNESS_TRUE_PEAK:g}:LRA=12'
+
+
+# Local SQLite database shared by the on-disk caches
+BOT_DB_PATH = os.getenv('BOT_DB_PATH', 'bot_data.db')
+
+# Stream URL / metadata cache settings
+STREAM_CACHE_SIZE = int(os.getenv('STREAM_CACHE_SIZE', '2048'))  # Max entries kept in memory
+STREAM_CACHE_TTL = int(os.getenv('STREAM_CACHE_TTL', '14400'))  # Fallback lifetime when the URL has no expiry (4 hours)
+STREAM_EXPIRY_MARGIN = int(os.getenv('STREAM_EXPIRY_MARGIN', '600'))  # Drop entries 10 minutes before the signed URL expires
+STREAM_CACHE_PERSIST = env_flag('STREAM_CACHE_PERSIST')  # Keep hot tracks on disk across restarts
+
+# Number of upcoming queue entries whose stream URL is resolved ahead of time
+RESOLVE_AHEAD = int(os.getenv('RESOLVE_AHEAD', '2'))
+
+# Persist queues and playback positions so a restart resumes where it left off
+PERSIST_STATE = env_flag('PERSIST_STATE', True)
+STATE_FLUSH_INTERVAL = int(os.getenv('STATE_FLUSH_INTERVAL', '5'))  # Seconds between batched writes
+
+# Measure loudness once per video and apply a static correction on later plays
+LOUDNESS_ANALYSIS = env_flag('LOUDNESS_ANALYSIS', True)
+LOUDNESS_MODE = os.getenv('LOUDNESS_MODE', 'gain').lower()  # 'gain' (volume filter) or 'linear' (two-pass loudnorm)
+LOUDNESS_ANALYSIS_CONCURRENCY = int(os.getenv('LOUDNESS_ANALYSIS_CONCURRENCY', '1'))
+
+# 'transcode' always re-encodes, 'passthrough' copies Opus streams untouched (no normalization),
+# 'auto' copies them once a measurement shows normalization wouldn't change much
+PLAYBACK_MODE = os.getenv('PLAYBACK_MODE', 'auto').lower()
+PASSTHROUGH_GAIN_TOLERANCE = float(os.getenv('PASSTHROUGH_GAIN_TOLERANCE', '1.0'))  # dB
+if PLAYBACK_MODE != 'transcode':
+    # Prefer Opus formats (itag 251) so they can be passed through
+    yt_dl_options['format'] = 'bestaudio[acodec=opus]/bestaudio/best'
+
+# Encoding profiles - the bitrate is further capped at the voice channel's bitrate
+ENCODE_PROFILES = {
+    'low-cpu': {'max_bitrate': 64, 'complexity': 3},
+    'balanced': {'max_bitrate': 128, 'complexity': 6},
+    'quality': {'max_bitrate': 384, 'complexity': 10},
 }
+DEFAULT_ENCODE_PROFILE = os.getenv('DEFAULT_ENCODE_PROFILE', 'balanced')
+
+# Optional on-disk cache of transcoded Opus files (disabled unless a directory is set)
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR')
+AUDIO_CACHE_MAX_MB = int(os.getenv('AUDIO_CACHE_MAX_MB', '2048'))
+AUDIO_CACHE_MAX_DURATION = int(os.getenv('AUDIO_CACHE_MAX_DURATION', '1200'))  # Don't cache tracks longer than 20 minutes
+AUDIO_CACHE_FILL_CONCURRENCY = int(os.getenv('AUDIO_CACHE_FILL_CONCURRENCY', '2'))
+
+# Where extractions run: 'thread' (default) or 'process' to spread them over all cores
+EXTRACT_BACKEND = os.getenv('EXTRACT_BACKEND', 'thread').lower()
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', str(os.cpu_count() or 1)))
+
+# Maximum number of yt-dlp extractions running at the same time (across all guilds),
+# one per worker process by default with the process backend
+EXTRACT_CONCURRENCY = int(os.getenv('EXTRACT_CONCURRENCY', '0')) or (
+    EXTRACT_WORKERS if EXTRACT_BACKEND == 'process' else 4)
+
+# Videos YouTube reported as private, removed or blocked fail instantly for a while instead of being extracted again
+UNAVAILABLE_CACHE_SIZE = int(os.getenv('UNAVAILABLE_CACHE_SIZE', '4096'))
+UNAVAILABLE_CACHE_TTL = int(os.getenv('UNAVAILABLE_CACHE_TTL', '21600'))  # 6 hours
+
+# Circuit breaker - a spike of failed extractions (429s, bot checks) pauses extractions and lowers their concurrency
+BREAKER_WINDOW = float(os.getenv('BREAKER_WINDOW', '60'))  # Seconds of extraction results the error rate is measured over
+BREAKER_ERROR_RATE = float(os.getenv('BREAKER_ERROR_RATE', '0.5'))  # Share of failures in the window that trips it
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', '5'))  # Results needed in the window before it can trip
+BREAKER_BACKOFF = float(os.getenv('BREAKER_BACKOFF', '30'))  # Seconds of the first pause, doubled on each trip in a row
+BREAKER_MAX_BACKOFF = float(os.getenv('BREAKER_MAX_BACKOFF', '600'))
+
+# Search result cache and autocomplete history
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', '4096'))  # Max remembered queries and indexed songs
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', '604800'))  # How long a query keeps its result (7 days)
+SEARCH_HISTORY_PERSIST = env_flag('SEARCH_HISTORY_PERSIST', True)  # Keep searches and play counts across restarts
+
+# Leave voice after this long without playing (servers can change it with /idle) or without listeners
+IDLE_TIMEOUT = int(os.getenv('IDLE_TIMEOUT', '3600'))
+ALONE_TIMEOUT = int(os.getenv('ALONE_TIMEOUT', '60'))
+
+# Resuming tracks whose stream or voice connection dropped
+RESUME_ATTEMPTS = int(os.getenv('RESUME_ATTEMPTS', '3'))  # Resumes in a row that may fail before a track is skipped
+VOICE_RECONNECT_TIMEOUT = int(os.getenv('VOICE_RECONNECT_TIMEOUT', '15'))  # Seconds to wait for discord.py to reconnect voice
+
+# Retries when a track's audio source can't be created, with exponential backoff
+PLAY_RETRIES = int(os.getenv('PLAY_RETRIES', '2'))
+PLAY_RETRY_BACKOFF = float(os.getenv('PLAY_RETRY_BACKOFF', '1.0'))  # Seconds before the first retry, doubled each time
+
+# Broadcast mode - servers that turn it on share one ffmpeg per track instead of one per server
+BROADCAST_DEFAULT = env_flag('BROADCAST_DEFAULT')  # Mode for servers that haven't used /broadcast
+BROADCAST_BUFFER_SECONDS = float(os.getenv('BROADCAST_BUFFER_SECONDS', '5'))  # Frames kept for listeners running behind
+
+# How audio is read: 'ffmpeg' spawns a process per track, 'pyav' decodes in process with PyAV
+AUDIO_BACKEND = os.getenv('AUDIO_BACKEND', 'ffmpeg').lower()
+if AUDIO_BACKEND == 'pyav' and av is None:
+  print("⚠️ AUDIO_BACKEND=pyav but PyAV isn't installed (pip install av) - using ffmpeg")
+  AUDIO_BACKEND = 'ffmpeg'
+
+# Opus frames (20 ms each) read ahead of the voice client to ride out network hiccups, 0 to disable
+READ_AHEAD_FRAMES = int(os.getenv('READ_AHEAD_FRAMES', '50'))
+
+# Outbound channel messages - Discord allows about 5 messages per 5 seconds per channel
+MESSAGE_RATE = int(os.getenv('MESSAGE_RATE', '5'))  # Messages and edits per channel per MESSAGE_RATE_PERIOD
+MESSAGE_RATE_PERIOD = 5.0
+NOW_PLAYING_DEBOUNCE = float(os.getenv('NOW_PLAYING_DEBOUNCE', '1.0'))  # Seconds now-playing updates are gathered
+INTERACTION_GRACE = 2.0  # Seconds cosmetic updates hold back after a command is used in the channel
 
 # Function to handle bot login with retry logic
 async def start_bot():
@@ -56,30 +215,171 @@ async def start_bot():
         raise
 
 
+# One-time startup work - setup_hook runs once per process, unlike on_ready
+@bot.event
+async def setup_hook():
+  # Schedule periodic cleanup and the idle timers
+  bot.loop.create_task(periodic_cleanup())
+  bot.loop.create_task(idle_tracker.run())
+
+  # Bring hot tracks back from the on-disk stream cache
+  if STREAM_CACHE_PERSIST:
+    warmed = await bot.loop.run_in_executor(None, stream_cache.warm_from_disk)
+    print(f"Loaded {warmed} cached streams from disk")
+
+  # Searches and play history for /search autocomplete
+  if SEARCH_HISTORY_PERSIST:
+    loaded = await bot.loop.run_in_executor(None, search_index.warm_from_disk)
+    print(f"Loaded {loaded} saved searches and played songs")
+
+  # Answer status requests from the launcher
+  if CONTROL_PORT:
+    try:
+      await asyncio.start_server(handle_control_client, '127.0.0.1', CONTROL_PORT)
+      print(f"Control channel listening on 127.0.0.1:{CONTROL_PORT}")
+    except OSError as e:
+      print(f"⚠️ Could not open control channel: {e}")
+
+  # Serve metrics for Prometheus
+  bot.loop.create_task(monitor_event_loop_lag())
+  if METRICS_PORT:
+    try:
+      await asyncio.start_server(handle_metrics_client, METRICS_HOST, METRICS_PORT)
+      print(f"Metrics available at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e:
+      print(f"⚠️ Could not open metrics endpoint: {e}")
+
+  if state_store:
+    bot.loop.create_task(state_store.run())
+
+  # The rest needs the guild list, which is only there once the bot is ready
+  bot.loop.create_task(after_first_ready())
+
+
+async def after_first_ready():
+  """Sync commands and resume saved queues once the first ready event has fired"""
+  await bot.wait_until_ready()
+
+  try:
+    await sync_commands()
+  except Exception as e:
+    print(f"⚠️ Error syncing commands: {e}")
+
+  # Resume saved queues
+  if state_store:
+    try:
+      await restore_state()
+    except Exception as e:
+      print(f"⚠️ Error restoring saved state: {e}")
+
+
+# Commands answer through their interaction - keep cosmetic channel updates out of their way
+@bot.event
+async def on_interaction(interaction):
+  # Autocomplete fires on every keystroke and gets no message in the channel, so it doesn't count
+  if interaction.type in (discord.InteractionType.application_command, discord.InteractionType.component):
+    message_scheduler.hold(interaction.channel_id)
+
+
 # Handle bot startup and log login info
 @bot.event
 async def on_ready():
   print(f'Logged in as {bot.user}')
 
-  try:
-    # 🛠 Debug: Print registered commands before syncing
-    registered_commands = [cmd.name for cmd in bot.tree.get_commands()]
-    print(f"Registered commands before sync: {registered_commands}")
 
-    # 🔄 Step 1: Clear and re-sync global commands
-    await bot.tree.sync()
-    print("✅ All commands forced to sync globally.")
+# Stable fingerprint of the commands registered for a scope
+def command_tree_hash(guild=None):
+  """Hash the payload that bot.tree.sync() would send for the global scope or a guild"""
+  payload = [command.to_dict(bot.tree) for command in bot.tree.get_commands(guild=guild)]
+  payload.sort(key=lambda command: (command.get('type', 1), command['name']))
+  return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
 
-    # 🔄 Step 2: Manually sync commands per server (forces immediate update)
-    for guild in bot.guilds:
+
+async def sync_scope(scope, guild=None):
+  """Sync one scope if its command tree changed since the last successful sync"""
+  db = get_db()
+  tree_hash = command_tree_hash(guild)
+  rows = await bot.loop.run_in_executor(
+      None, db.execute, 'SELECT hash FROM command_sync WHERE scope = ?', (scope,))
+  if rows and rows[0][0] == tree_hash:
+    return False
+
+  for attempt in range(3):
+    try:
       await bot.tree.sync(guild=guild)
+      break
+    except discord.HTTPException as e:
+      if e.status != 429 or attempt == 2:
+        raise
+      retry_after = getattr(e, 'retry_after', None) or COMMAND_SYNC_PACING * 10
+      print(f"Rate limited while syncing {scope}. Retrying in {retry_after:.1f} seconds...")
+      await asyncio.sleep(retry_after)
+
+  await bot.loop.run_in_executor(
+      None, db.execute, 'INSERT OR REPLACE INTO command_sync VALUES (?, ?, ?)',
+      (scope, tree_hash, time.time()))
+  return True
+
+
+async def sync_commands():
+  """Push slash commands to Discord, skipping every scope that is already up to date"""
+  await bot.loop.run_in_executor(
+      None, get_db().execute,
+      'CREATE TABLE IF NOT EXISTS command_sync (scope TEXT PRIMARY KEY, hash TEXT, synced_at REAL)')
+
+  # 🛠 Debug: Print registered commands before syncing
+  registered_commands = [cmd.name for cmd in bot.tree.get_commands()]
+  print(f"Registered commands before sync: {registered_commands}")
+
+  # 🔄 Step 1: Global commands - only one shard process needs to do this
+  shard_ids = getattr(bot, 'shard_ids', None)
+  if shard_ids is None or 0 in shard_ids:
+    if await sync_scope('global'):
+      print("✅ Global commands changed - synced globally.")
+    else:
+      print("✅ Global commands unchanged - skipped sync.")
+
+  # 🔄 Step 2: Per server commands, paced to stay clear of rate limits
+  synced = 0
+  for guild in bot.guilds:
+    if await sync_scope(f'guild:{guild.id}', guild):
+      synced += 1
       print(f"✅ Synced commands for {guild.name} ({guild.id})")
-      
-    # Schedule periodic cleanup
-    bot.loop.create_task(periodic_cleanup())
+      await asyncio.sleep(COMMAND_SYNC_PACING)
+  print(f"✅ Command sync done - {synced}/{len(bot.guilds)} servers needed an update.")
 
-  except Exception as e:
-    print(f"⚠️ Error syncing commands: {e}")
+
+# Re-target encoding when the bot is moved to another voice channel
+@bot.event
+async def on_voice_state_update(member, before, after):
+  guild_id = member.guild.id
+  if member.id == bot.user.id:
+    if after.channel is None:
+      # Kicked or the channel was deleted - free the guild's resources right away
+      if guild_id in voice_clients and guild_id not in reconnecting_guilds:
+        print(f"Disconnected from voice in guild {guild_id} - releasing its resources")
+        del voice_clients[guild_id]
+        release_playback_state(guild_id)
+      return
+    if before.channel != after.channel:
+      retarget_encoding(guild_id)
+    update_idle_timer(guild_id)
+    return
+
+  # Someone joined or left the bot's channel - it may be alone now, or not any more
+  channel = getattr(voice_clients.get(guild_id), 'channel', None)
+  if channel is not None and before.channel != after.channel and channel in (before.channel, after.channel):
+    update_idle_timer(guild_id)
+
+
+# Re-target encoding when the bitrate of the bot's channel is changed
+@bot.event
+async def on_guild_channel_update(before, after):
+  if getattr(before, 'bitrate', None) == getattr(after, 'bitrate', None):
+    return
+  voice_client = voice_clients.get(after.guild.id)
+  if voice_client and voice_client.channel and voice_client.channel.id == after.id:
+    retarget_encoding(after.guild.id)
 
 
 # Helper function to ensure the bot is connected to voice
@@ -99,179 +399,2932 @@ async def ensure_voice_connection(interaction, user_voice_channel=None):
     if user_voice_channel:
         voice_client = await user_voice_channel.connect()
         voice_clients[guild_id] = voice_client
-        
-        # Initialize queue if needed
-        if guild_id not in song_queues:
-            song_queues[guild_id] = []
+        update_idle_timer(guild_id)
             
         return voice_client
     else:
         return None
 
 
-# Utility function to extract audio information
-async def extract_audio_info(url, loop):
-    """Extract audio information from a URL"""
-    def _extract():
-        try:
-            info = ytdl.extract_info(url, download=False)
-            
-            # Check if this is a search result or playlist
-            if 'entries' in info:
-                # Get the first entry for searches
-                entry = info['entries'][0]
-                if os.getenv('DEBUG'):  # Only print in debug mode
-                    print(f"Entry keys: {list(entry.keys())}")
-                    # Print format information if available
-                    if 'formats' in entry:
-                        print_format_info(entry)
-                return entry
+# Thread-safe wrapper around a single SQLite connection
+class SqliteStore:
+    """Small SQLite helper shared by everything that persists to disk"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
+    def execute(self, sql, params=()):
+        """Run a single statement and return all resulting rows"""
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+            self.conn.commit()
+            return rows
+
+    def executemany(self, sql, rows):
+        """Run a statement for every row inside one transaction"""
+        with self.lock:
+            self.conn.executemany(sql, rows)
+            self.conn.commit()
+
+
+_db = None
+
+
+def get_db():
+    """Open the shared database on first use"""
+    global _db
+    if _db is None:
+        _db = SqliteStore(BOT_DB_PATH)
+    return _db
+
+
+# 📈 Metrics, exposed in the Prometheus text format
+metrics_registry = []
+
+
+class Metric:
+    """Base class for a metric family with optional labels"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}  # sorted label tuple -> value
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    @staticmethod
+    def _format_labels(pairs):
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"') for _, value in pairs)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+    def samples(self):
+        """Yield (name suffix, label pairs, value) for every series"""
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in items:
+            yield '', key, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, pairs, value in self.samples():
+            lines.append(f"{self.name}{suffix}{self._format_labels(pairs)} {value}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down, optionally computed when scraped"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function=None):
+        super().__init__(name, documentation)
+        self.function = function  # Returns {label dict as tuple of pairs: value}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.function is None:
+            yield from super().samples()
+            return
+        for labels, value in self.function().items():
+            yield '', self._key(dict(labels)), value
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets"""
+
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self.lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items()]
+        for key, (counts, total, count) in items:
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield '_bucket', key + (('le', f'{bound:g}'),), bucket_count
+            yield '_bucket', key + (('le', '+Inf'),), count
+            yield '_sum', key, total
+            yield '_count', key, count
+
+
+def render_metrics():
+    """Render every registered metric in the Prometheus text format"""
+    return '\n'.join(metric.render() for metric in metrics_registry) + '\n'
+
+
+extract_latency = Histogram('musicbot_extract_seconds', 'Latency of extract_audio_info calls')
+time_to_first_audio = Histogram('musicbot_time_to_first_audio_seconds',
+                                'Time from a /play, /search or /list interaction to audio starting')
+track_gap_seconds = Histogram('musicbot_track_gap_seconds', 'Silence between two consecutive tracks')
+audio_source_seconds = Histogram('musicbot_ffmpeg_spawn_seconds',
+                                 'Time to start an audio source (stage=spawn) and get its first frame (stage=first_frame)')
+extraction_failures = Counter('musicbot_extraction_failures_total', 'Extractions that returned no playable stream')
+playback_retries = Counter('musicbot_playback_retries_total', 'Retries after an audio player could not be created')
+playback_failures = Counter('musicbot_playback_failures_total', 'Tracks skipped because they could not be played')
+messages_coalesced = Counter('musicbot_messages_coalesced_total',
+                             'Channel messages and edits replaced by a newer one before they were sent')
+read_ahead_underruns = Counter('musicbot_read_ahead_underruns_total',
+                               'Frames the voice client had to wait for because the read-ahead buffer was empty')
+extraction_breaker_trips = Counter('musicbot_extraction_breaker_trips_total',
+                                   'Times a spike of failed extractions paused extracting')
+extractions_rejected = Counter('musicbot_extractions_rejected_total',
+                               'Extractions failed fast by the circuit breaker or the unavailable-video cache')
+playback_resumes = Counter('musicbot_playback_resumes_total', 'Tracks resumed at their last position after a failure')
+event_loop_lag = Gauge('musicbot_event_loop_lag_seconds', 'How late a 1 s sleep on the event loop wakes up')
+Gauge('musicbot_voice_clients', 'Connected voice clients',
+      function=lambda: {(): sum(1 for vc in voice_clients.values() if vc.is_connected())})
+Gauge('musicbot_queue_depth', 'Queued tracks per guild',
+      function=lambda: {(('guild', guild_id),): len(queue) for guild_id, queue in list(song_queues.items())})
+Gauge('musicbot_extractions_running', 'Extractions currently running',
+      function=lambda: {(): extraction_scheduler.running})
+Gauge('musicbot_executor_backlog', 'Extractions waiting for a free worker',
+      function=lambda: {(): extraction_scheduler.pending})
+Gauge('musicbot_extraction_limit', 'Extractions allowed at once right now (lowered by the circuit breaker)',
+      function=lambda: {(): extraction_scheduler.limit})
+Gauge('musicbot_extraction_breaker_open', 'Whether the extraction circuit breaker is open (1) or half-open (0.5)',
+      function=lambda: {(): {'closed': 0, 'half-open': 0.5, 'open': 1}[extraction_breaker.state]})
+Gauge('musicbot_read_ahead_fill_frames', 'Frames buffered ahead of the voice client per guild',
+      function=lambda: {(('guild', guild_id),): entry['source'].read_ahead.filled
+                        for guild_id, entry in list(now_playing.items()) if entry['source'].read_ahead})
+Gauge('musicbot_broadcasts', 'Shared broadcast pipelines running',
+      function=lambda: {(): len(broadcasts)})
+Gauge('musicbot_broadcast_listeners', 'Servers listening to a shared broadcast',
+      function=lambda: {(): sum(len(stream.listeners) for stream in list(broadcasts.values()))})
+Gauge('musicbot_messages_waiting', 'Channel messages and edits waiting for the rate limit',
+      function=lambda: {(): message_scheduler.pending})
+
+
+async def monitor_event_loop_lag():
+    """Measure how far behind the event loop is running"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(1)
+        event_loop_lag.set(max(0.0, loop.time() - started - 1))
+
+
+async def handle_metrics_client(reader, writer):
+    """Serve the metrics page over a minimal HTTP/1.0 response"""
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+        path = request.split(b' ', 2)[1] if request.count(b' ') >= 2 else b'/'
+        if path.split(b'?')[0] in (b'/', b'/metrics'):
+            body = render_metrics().encode()
+            status = b'200 OK'
+        else:
+            body = b'Not found\n'
+            status = b'404 Not Found'
+        writer.write(b'HTTP/1.0 ' + status + b'\r\n'
+                     b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+        await writer.drain()
+    except Exception as e:
+        print(f"Error serving metrics: {e}")
+    finally:
+        writer.close()
+
+
+# Pattern matching the 11 character video ID in the common YouTube URL shapes
+YOUTUBE_ID_PATTERN = re.compile(
+    r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/)|youtu\.be/)([A-Za-z0-9_-]{11})')
+
+
+def get_video_id(url):
+    """Return the YouTube video ID for a URL, or None if it isn't a video URL"""
+    match = YOUTUBE_ID_PATTERN.search(url)
+    return match.group(1) if match else None
+
+
+def get_stream_expiry(stream_url):
+    """Read the signed `expire` timestamp from a googlevideo stream URL"""
+    try:
+        parsed = urlparse(stream_url)
+        expire = parse_qs(parsed.query).get('expire')
+        if expire:
+            return int(expire[0])
+        # Manifest style URLs carry it in the path instead (/expire/<ts>/)
+        match = re.search(r'/expire/(\d+)', parsed.path)
+        if match:
+            return int(match.group(1))
+    except (ValueError, TypeError):
+        pass
+    return None
+
+
+# 🗃️ Cache of resolved stream URLs and metadata, keyed by video ID
+class StreamCache:
+    """LRU + TTL cache that also respects the expiry of signed stream URLs"""
+
+    def __init__(self, max_size, ttl, expiry_margin, persist=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.expiry_margin = expiry_margin
+        self.persist = persist
+        self.entries = OrderedDict()  # video_id -> (expires_at, info)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.persist:
+            get_db().execute(
+                'CREATE TABLE IF NOT EXISTS stream_cache ('
+                'video_id TEXT PRIMARY KEY, expires_at REAL, last_used REAL, info TEXT)')
+
+    def _expires_at(self, info):
+        """Work out when an entry must be dropped"""
+        expires_at = time.time() + self.ttl
+        expire = get_stream_expiry(info.get('url') or '')
+        if expire:
+            expires_at = min(expires_at, expire - self.expiry_margin)
+        return expires_at
+
+    def get(self, video_id):
+        """Return cached info from memory, or None if missing or stale"""
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, info = entry
+            if expires_at <= time.time():
+                del self.entries[video_id]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(video_id)
+            self.hits += 1
+            return info
+
+    def load(self, video_id):
+        """Look the video up in the on-disk tier (blocking - run in an executor)"""
+        if not self.persist:
+            return None
+        rows = get_db().execute(
+            'SELECT expires_at, info FROM stream_cache WHERE video_id = ?', (video_id,))
+        if not rows or rows[0][0] <= time.time():
+            return None
+        info = json.loads(rows[0][1])
+        self._remember(video_id, rows[0][0], info)
+        return info
+
+    def put(self, info):
+        """Cache an info dict and return its slimmed down copy"""
+        info = slim_info(info)
+        video_id = info.get('id')
+        if not video_id or not info.get('url'):
+            return info
+        expires_at = self._expires_at(info)
+        if expires_at <= time.time():
+            return info
+        self._remember(video_id, expires_at, info)
+        if self.persist:
+            get_db().execute(
+                'INSERT OR REPLACE INTO stream_cache VALUES (?, ?, ?, ?)',
+                (video_id, expires_at, time.time(), json.dumps(info)))
+        return info
+
+    def _remember(self, video_id, expires_at, info):
+        with self.lock:
+            self.entries[video_id] = (expires_at, info)
+            self.entries.move_to_end(video_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, video_id):
+        """Forget a video, e.g. after its stream URL stopped working"""
+        with self.lock:
+            self.entries.pop(video_id, None)
+        if self.persist:
+            get_db().execute('DELETE FROM stream_cache WHERE video_id = ?', (video_id,))
+
+    def warm_from_disk(self):
+        """Load the most recently used, still valid entries (blocking)"""
+        if not self.persist:
+            return 0
+        db = get_db()
+        db.execute('DELETE FROM stream_cache WHERE expires_at <= ?', (time.time(),))
+        rows = db.execute(
+            'SELECT video_id, expires_at, info FROM stream_cache ORDER BY last_used DESC LIMIT ?',
+            (self.max_size,))
+        # Insert oldest first so the LRU order matches the stored usage order
+        for video_id, expires_at, info in reversed(rows):
+            self._remember(video_id, expires_at, json.loads(info))
+        return len(rows)
+
+    def prune(self):
+        """Drop every expired entry from memory"""
+        now = time.time()
+        with self.lock:
+            stale = [vid for vid, (expires_at, _) in self.entries.items() if expires_at <= now]
+            for video_id in stale:
+                del self.entries[video_id]
+        return len(stale)
+
+
+stream_cache = StreamCache(STREAM_CACHE_SIZE, STREAM_CACHE_TTL, STREAM_EXPIRY_MARGIN,
+                           persist=STREAM_CACHE_PERSIST)
+
+
+# 🚫 Videos that can't be played (private, removed, region-locked...)
+class UnavailableCache:
+    """LRU + TTL cache of video IDs YouTube refused, with the reason it gave"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # video_id -> (expires_at, reason)
+        self.hits = 0
+
+    def get(self, video_id, count=True):
+        """Return why a video is unavailable, or None if it isn't known to be"""
+        entry = self.entries.get(video_id)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self.entries[video_id]
+            return None
+        if count:
+            self.entries.move_to_end(video_id)
+            self.hits += 1
+        return entry[1]
+
+    def put(self, video_id, reason):
+        self.entries[video_id] = (time.time() + self.ttl, reason)
+        self.entries.move_to_end(video_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def prune(self):
+        """Drop every expired entry"""
+        now = time.time()
+        stale = [vid for vid, (expires_at, _) in self.entries.items() if expires_at <= now]
+        for video_id in stale:
+            del self.entries[video_id]
+        return len(stale)
+
+
+unavailable_videos = UnavailableCache(UNAVAILABLE_CACHE_SIZE, UNAVAILABLE_CACHE_TTL)
+
+
+# ⚙️ Scheduler for blocking yt-dlp work
+class ExtractionScheduler:
+    """Runs extractions with a global concurrency cap and round-robin fairness between guilds"""
+
+    def __init__(self, concurrency, backend='thread', workers=None, options=None):
+        self.backend = backend
+        self.workers = workers or concurrency
+        # More jobs than worker processes would only wait inside the pool, past the fair queues
+        self.concurrency = min(concurrency, self.workers) if backend == 'process' else concurrency
+        self.options = options or {}  # yt-dlp options handed to every worker
+        self._executor = None
+        self.queues = OrderedDict()  # guild_id -> deque of (future, func, args)
+        self.running = 0
+        self.limit = concurrency  # Jobs started at once right now - the circuit breaker lowers it
+
+    @property
+    def executor(self):
+        """Create the worker pool on first use"""
+        if self._executor is None:
+            if self.backend == 'process':
+                # Long-lived worker processes, each with its own warmed YoutubeDL. They are spawned
+                # rather than forked, because this process already runs threads
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=init_extract_worker,
+                                                     initargs=(self.options,))
             else:
-                # Direct URL
-                if os.getenv('DEBUG'):  # Only print in debug mode
-                    print_format_info(info)
-                return info
-                
-        except Exception as e:
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                                    thread_name_prefix='extract',
+                                                    initializer=init_extract_worker,
+                                                    initargs=(self.options,))
+        return self._executor
+
+    @property
+    def pending(self):
+        """Number of jobs waiting for a free slot"""
+        return sum(len(jobs) for jobs in self.queues.values())
+
+    def submit(self, guild_id, func, *args):
+        """Queue a blocking call for a guild and return a future with its result"""
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(guild_id, deque()).append((future, func, args))
+        self._dispatch()
+        return future
+
+    async def run(self, guild_id, func, *args):
+        """Run a blocking call through the scheduler and wait for it"""
+        return await self.submit(guild_id, func, *args)
+
+    def set_limit(self, limit):
+        """Change how many jobs may run at once (between 1 and the configured concurrency)"""
+        self.limit = max(1, min(limit, self.concurrency))
+        self._dispatch()
+
+    def reject_pending(self, exception):
+        """Fail every job that is still waiting for a slot"""
+        queues, self.queues = self.queues, OrderedDict()
+        for jobs in queues.values():
+            for future, func, args in jobs:
+                if not future.done():
+                    future.set_exception(exception)
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while self.running < self.limit and self.queues:
+            # Take one job from the guild at the front, then move that guild to the back
+            guild_id, jobs = self.queues.popitem(last=False)
+            future, func, args = jobs.popleft()
+            if jobs:
+                self.queues[guild_id] = jobs
+            if future.cancelled():
+                continue
+            self.running += 1
+            try:
+                job = asyncio.wrap_future(self.executor.submit(func, *args), loop=loop)
+            except Exception as e:
+                # The pool could not take the job (e.g. a worker process failed to start)
+                print(f"Could not start an extraction: {e}")
+                self.running -= 1
+                if isinstance(e, BrokenProcessPool):
+                    self._executor = None
+                future.set_exception(e)
+                continue
+            job.add_done_callback(partial(self._finished, future))
+
+    def _finished(self, future, job):
+        self.running -= 1
+        if not future.cancelled():
+            if job.cancelled():
+                future.cancel()
+            elif job.exception() is not None:
+                if isinstance(job.exception(), BrokenProcessPool):
+                    # A worker died - start a fresh pool for the next job
+                    print(f"Extraction worker pool broke: {job.exception()}")
+                    self._executor = None
+                future.set_exception(job.exception())
+            else:
+                future.set_result(job.result())
+        self._dispatch()
+
+
+extraction_scheduler = ExtractionScheduler(EXTRACT_CONCURRENCY, EXTRACT_BACKEND, EXTRACT_WORKERS,
+                                           options=yt_dl_options)
+
+
+# 🧯 Circuit breaker for extractions
+class ExtractionBreaker:
+    """Pauses extractions when too many fail, then lets them back in one probe and one slot at a time"""
+
+    def __init__(self, scheduler, window, error_rate, min_calls, backoff, max_backoff):
+        self.scheduler = scheduler
+        self.window = window
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = 'closed'  # 'closed' (normal), 'open' (failing fast) or 'half-open' (one probe allowed)
+        self.outcomes = deque()  # (time, failed) of recent extractions
+        self.open_until = 0.0
+        self.trips = 0  # Trips since the last successful probe, for the backoff
+        self.probing = False
+        self.successes = 0  # Successes since the concurrency limit was last raised
+        self.last_error = None
+
+    @property
+    def retry_after(self):
+        """Seconds until extractions are attempted again"""
+        return max(0.0, self.open_until - time.monotonic())
+
+    def describe(self):
+        """Explain to users why their song can't be loaded right now"""
+        wait = math.ceil(self.retry_after)
+        when = f"in about {wait}s" if wait else "in a moment"
+        return f"YouTube is rate-limiting the bot, so songs can't be loaded right now. Try again {when}."
+
+    def allow(self):
+        """Check if an extraction may run now (in half-open state only the first caller gets to probe)"""
+        if self.state == 'open':
+            if time.monotonic() < self.open_until:
+                return False
+            self.state = 'half-open'
+            self.probing = False
+        if self.state == 'half-open':
+            if self.probing:
+                return False
+            self.probing = True
+        return True
+
+    def release(self):
+        """The probe was cancelled before it finished - let the next caller probe instead"""
+        self.probing = False
+
+    def record(self, kind=None, message=None):
+        """Count the result of an extraction: None for success, otherwise an ExtractionError kind"""
+        if self.state == 'open' or kind == 'blocked':
+            return  # Stragglers from before the trip don't say anything about now
+        now = time.monotonic()
+        failed = kind in ('throttled', 'error')  # An unavailable video is a perfectly healthy answer
+        if self.state == 'half-open':
+            if failed:
+                self.trip(message)
+                return
+            self.state = 'closed'
+            self.probing = False
+            self.trips = 0
+            print(f"✅ Extractions are working again (limit {self.scheduler.limit}/{self.scheduler.concurrency})")
+
+        self.outcomes.append((now, failed))
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            self.outcomes.popleft()
+        if failed:
+            self.last_error = message
+            self.successes = 0
+            failures = sum(1 for _, f in self.outcomes if f)
+            if len(self.outcomes) >= self.min_calls and failures >= self.error_rate * len(self.outcomes):
+                self.trip(message)
+        elif self.scheduler.limit < self.scheduler.concurrency:
+            # Additive increase - one more slot after a full round of successes at the current limit
+            self.successes += 1
+            if self.successes >= self.scheduler.limit:
+                self.successes = 0
+                self.scheduler.set_limit(self.scheduler.limit + 1)
+
+    def trip(self, message):
+        """Stop extracting for a while and halve the concurrency"""
+        self.trips += 1
+        delay = min(self.backoff * 2 ** (self.trips - 1), self.max_backoff)
+        delay *= random.uniform(0.8, 1.2)  # Jitter, so several processes don't come back in lockstep
+        self.state = 'open'
+        self.open_until = time.monotonic() + delay
+        self.probing = False
+        self.outcomes.clear()
+        self.successes = 0
+        self.scheduler.set_limit(self.scheduler.limit // 2)
+        extraction_breaker_trips.inc()
+        print(f"⚠️ Too many extractions failing ({message}) - pausing them for {delay:.0f}s, "
+              f"then at most {self.scheduler.limit} at once")
+        # Jobs still waiting would only fail slowly, so fail them now
+        self.scheduler.reject_pending(ExtractionError('blocked', self.describe()))
+
+    def status(self):
+        """Short summary for /status"""
+        if self.state == 'open':
+            return f"open, retrying in {math.ceil(self.retry_after)}s"
+        return self.state
+
+
+extraction_breaker = ExtractionBreaker(extraction_scheduler, BREAKER_WINDOW, BREAKER_ERROR_RATE,
+                                       BREAKER_MIN_CALLS, BREAKER_BACKOFF, BREAKER_MAX_BACKOFF)
+
+
+async def run_extraction_job(guild_id, func, *args):
+    """Run an extraction through the circuit breaker and the scheduler, raising ExtractionError on failure"""
+    if not extraction_breaker.allow():
+        extractions_rejected.inc()
+        raise ExtractionError('blocked', extraction_breaker.describe())
+    try:
+        result = await extraction_scheduler.run(guild_id, func, *args)
+    except asyncio.CancelledError:
+        extraction_breaker.release()
+        raise
+    except ExtractionError as e:
+        extraction_breaker.record(e.kind, e.reason)
+        raise
+    except Exception as e:
+        extraction_breaker.record('error', str(e))
+        raise ExtractionError('error', str(e)) from e
+    extraction_breaker.record()
+    return result
+
+
+def describe_extraction_failure(url):
+    """Explain why a URL couldn't be loaded, if the reason is known"""
+    video_id = get_video_id(url)
+    reason = unavailable_videos.get(video_id, count=False) if video_id else None
+    if reason:
+        return f"This video is unavailable ({reason})."
+    if extraction_breaker.state != 'closed':
+        return extraction_breaker.describe()
+    return None
+
+
+# Utility function to extract audio information
+async def extract_audio_info(url, loop, guild_id=None):
+    """Extract audio information from a URL, serving repeat videos from the cache"""
+    started = time.perf_counter()
+    info = await _extract_audio_info(url, loop, guild_id)
+    extract_latency.observe(time.perf_counter() - started)
+    if info is None:
+        extraction_failures.inc()
+    return info
+
+
+async def _extract_audio_info(url, loop, guild_id):
+    video_id = get_video_id(url)
+    if video_id:
+        cached = stream_cache.get(video_id)
+        if cached:
+            return cached
+        if unavailable_videos.get(video_id):
+            extractions_rejected.inc()
+            return None
+
+        # Check the on-disk tier before paying for a full extraction
+        if STREAM_CACHE_PERSIST:
+            cached = await loop.run_in_executor(None, stream_cache.load, video_id)
+            if cached:
+                return cached
+
+    try:
+        info = await run_extraction_job(guild_id, run_extraction, url)
+    except ExtractionError as e:
+        if e.kind == 'unavailable' and video_id:
+            unavailable_videos.put(video_id, e.reason)
+        if e.kind != 'blocked':
             print(f"Error extracting info: {e}")
+        return None
+    if info is None:
+        return None
+
+    # Writing through to the on-disk tier is blocking, so keep it off the event loop
+    if STREAM_CACHE_PERSIST:
+        return await loop.run_in_executor(None, stream_cache.put, info)
+    return stream_cache.put(info)
+
+
+# 🔎 Search results and play history, indexed by prefix for autocomplete
+def normalize_query(text):
+    """Lower-case a query and collapse punctuation and whitespace"""
+    return ' '.join(re.sub(r'[\W_]+', ' ', text.lower()).split())
+
+
+class SearchIndex:
+    """Caches query -> video results and answers autocomplete prefixes from a sorted key list"""
+
+    MAX_KEY_WORDS = 8  # Index suffixes starting at each of the first few words, so "rhapsody" finds "bohemian rhapsody"
+    SCAN_LIMIT = 500  # Keys looked at per autocomplete request
+
+    def __init__(self, max_size, ttl, persist=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist = persist
+        self.results = OrderedDict()  # normalized query -> (expires_at, video_id)
+        self.videos = {}  # video_id -> {'title': ..., 'plays': ..., 'keys': set of index keys}
+        self.keys = []  # sorted (key, video_id) pairs
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.persist:
+            db = get_db()
+            db.execute('CREATE TABLE IF NOT EXISTS search_cache ('
+                       'query TEXT PRIMARY KEY, video_id TEXT, title TEXT, expires_at REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS play_history ('
+                       'video_id TEXT PRIMARY KEY, title TEXT, plays INTEGER, last_played REAL)')
+
+    def _video(self, video_id, title):
+        video = self.videos.get(video_id)
+        if video is None:
+            video = self.videos[video_id] = {'title': title, 'plays': 0, 'keys': set()}
+        elif title:
+            video['title'] = title
+        return video
+
+    def _index(self, video_id, text):
+        video = self.videos[video_id]
+        words = normalize_query(text).split()
+        for start in range(min(len(words), self.MAX_KEY_WORDS)):
+            key = (' '.join(words[start:]), video_id)
+            if key not in video['keys']:
+                video['keys'].add(key)
+                bisect.insort(self.keys, key)
+
+    def _drop_video(self, video_id):
+        for key in self.videos.pop(video_id)['keys']:
+            position = bisect.bisect_left(self.keys, key)
+            if position < len(self.keys) and self.keys[position] == key:
+                del self.keys[position]
+
+    def lookup(self, query):
+        """Return the video ID a query resolved to before, or None"""
+        query = normalize_query(query)
+        with self.lock:
+            entry = self.results.get(query)
+            if entry is None or entry[0] <= time.time():
+                self.misses += 1
+                return None
+            self.results.move_to_end(query)
+            self.hits += 1
+            return entry[1]
+
+    def remember_search(self, query, video_id, title):
+        """Store the result of a search (blocking when persisted - run in an executor)"""
+        query = normalize_query(query)
+        if not query or not video_id:
+            return
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            self._remember_search(query, video_id, title, expires_at)
+        if self.persist:
+            get_db().execute('INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?, ?)',
+                             (query, video_id, title, expires_at))
+
+    def _remember_search(self, query, video_id, title, expires_at):
+        self.results[query] = (expires_at, video_id)
+        self.results.move_to_end(query)
+        while len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+        self._video(video_id, title)
+        self._index(video_id, query)
+        if title:
+            self._index(video_id, title)
+
+    def record_play(self, video_id, title):
+        """Count a play of a song (blocking when persisted - run in an executor)"""
+        if not video_id or not title or title.startswith('http'):
+            return
+        with self.lock:
+            video = self._video(video_id, title)
+            video['plays'] += 1
+            plays = video['plays']
+            self._index(video_id, title)
+        if self.persist:
+            get_db().execute('INSERT OR REPLACE INTO play_history VALUES (?, ?, ?, ?)',
+                             (video_id, title, plays, time.time()))
+
+    def suggest(self, prefix, limit=25):
+        """Return up to `limit` (video_id, title) pairs for a typed prefix, most played first"""
+        prefix = normalize_query(prefix)
+        with self.lock:
+            if prefix:
+                start = bisect.bisect_left(self.keys, (prefix,))
+                candidates = set()
+                for key, video_id in self.keys[start:start + self.SCAN_LIMIT]:
+                    if not key.startswith(prefix):
+                        break
+                    candidates.add(video_id)
+            else:
+                candidates = self.videos.keys()
+            ranked = heapq.nlargest(limit, candidates, key=lambda vid: self.videos[vid]['plays'])
+            return [(video_id, self.videos[video_id]['title']) for video_id in ranked]
+
+    def warm_from_disk(self):
+        """Load saved searches and the most played songs (blocking)"""
+        if not self.persist:
+            return 0
+        db = get_db()
+        now = time.time()
+        db.execute('DELETE FROM search_cache WHERE expires_at <= ?', (now,))
+        history = db.execute('SELECT video_id, title, plays FROM play_history ORDER BY plays DESC LIMIT ?',
+                             (self.max_size,))
+        searches = db.execute('SELECT query, video_id, title, expires_at FROM search_cache '
+                              'ORDER BY expires_at LIMIT ?', (self.max_size,))
+        with self.lock:
+            for video_id, title, plays in history:
+                self._video(video_id, title)['plays'] = plays
+                self._index(video_id, title)
+            for query, video_id, title, expires_at in searches:
+                self._remember_search(query, video_id, title, expires_at)
+        return len(history) + len(searches)
+
+    def prune(self):
+        """Drop expired searches and songs that nothing points at any more"""
+        now = time.time()
+        with self.lock:
+            for query in [q for q, (expires_at, _) in self.results.items() if expires_at <= now]:
+                del self.results[query]
+            searched = {video_id for _, video_id in self.results.values()}
+            unused = [vid for vid, video in self.videos.items() if not video['plays'] and vid not in searched]
+            # Keep the history bounded, forgetting the least played songs first
+            excess = len(self.videos) - len(unused) - self.max_size
+            if excess > 0:
+                played = [vid for vid in self.videos if vid not in searched and self.videos[vid]['plays']]
+                unused += heapq.nsmallest(excess, played, key=lambda vid: self.videos[vid]['plays'])
+            for video_id in unused:
+                self._drop_video(video_id)
+        return len(unused)
+
+
+search_index = SearchIndex(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, persist=SEARCH_HISTORY_PERSIST)
+
+# Autocomplete choices carry the video ID, so picking one skips the search
+SUGGESTION_PATTERN = re.compile(r'^yt:([A-Za-z0-9_-]{11})$')
+
+
+# 🎶 A single queued song
+class Track:
+    """Queue entry - the stream URL stays None until the track is resolved"""
+
+    __slots__ = ('id', 'title', 'url', 'webpage_url', 'duration', 'codec', 'resume_at', 'resume_attempts',
+                 'counted_duration')
+
+    def __init__(self, id, title, url=None, webpage_url=None, duration=None, codec=None):
+        self.id = id
+        self.title = title
+        self.url = url
+        self.webpage_url = webpage_url
+        self.duration = duration
+        self.codec = codec
+        self.resume_at = 0  # Seconds to seek to when the track starts
+        self.resume_attempts = 0  # Resumes since the track last played for a while
+        self.counted_duration = None  # Length included in its queue's total_duration (None when not queued)
+
+
+# 📜 Per-guild song queue
+class SongQueue:
+    """Deque backed queue with O(1) pop-front/append and an index of queued video IDs"""
+
+    def __init__(self, tracks=()):
+        self._tracks = deque()
+        self._index = {}  # video_id -> number of queued copies
+        self.version = 0  # Bumped on every change so the state store knows what to save
+        self.total_duration = 0  # Seconds of all queued tracks with a known length, kept up to date
+        self.unknown_durations = 0  # Queued tracks whose length isn't known (yet)
+        self.extend(tracks)
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def __bool__(self):
+        return bool(self._tracks)
+
+    def __iter__(self):
+        return iter(self._tracks)
+
+    def __getitem__(self, index):
+        return self._tracks[index]
+
+    def __contains__(self, video_id):
+        return video_id in self._index
+
+    def _add(self, track):
+        self.version += 1
+        track.counted_duration = track.duration or 0
+        self.total_duration += track.counted_duration
+        if not track.duration:
+            self.unknown_durations += 1
+        if track.id:
+            self._index[track.id] = self._index.get(track.id, 0) + 1
+
+    def _forget(self, track):
+        self.version += 1
+        self.total_duration -= track.counted_duration
+        if not track.counted_duration:
+            self.unknown_durations -= 1
+        track.counted_duration = None
+        if track.id:
+            count = self._index.get(track.id, 0) - 1
+            if count > 0:
+                self._index[track.id] = count
+            else:
+                self._index.pop(track.id, None)
+
+    def append(self, track):
+        """Add a track to the end of the queue"""
+        self._tracks.append(track)
+        self._add(track)
+
+    def appendleft(self, track):
+        """Put a track back at the front of the queue"""
+        self._tracks.appendleft(track)
+        self._add(track)
+
+    def extend(self, tracks):
+        """Add several tracks to the end of the queue"""
+        for track in tracks:
+            self.append(track)
+
+    def popleft(self):
+        """Remove and return the next track"""
+        track = self._tracks.popleft()
+        self._forget(track)
+        return track
+
+    def slice(self, start, stop):
+        """Return the tracks between two positions without copying the whole queue"""
+        return list(islice(self._tracks, start, stop))
+
+    def remove_range(self, start, count):
+        """Remove `count` tracks starting at `start` and return them"""
+        count = max(0, min(count, len(self._tracks) - start))
+        # Rotating the range to the front keeps this O(start + count) instead of O(n)
+        self._tracks.rotate(-start)
+        removed = [self._tracks.popleft() for _ in range(count)]
+        self._tracks.rotate(start)
+        for track in removed:
+            self._forget(track)
+        return removed
+
+    def move(self, source, destination):
+        """Move the track at one position to another position"""
+        track = self._tracks[source]
+        del self._tracks[source]
+        self._tracks.insert(destination, track)
+        self.version += 1
+        return track
+
+    def shuffle(self):
+        """Shuffle the queue in place"""
+        tracks = list(self._tracks)
+        random.shuffle(tracks)
+        self._tracks = deque(tracks)
+        self.version += 1
+
+    def clear(self):
+        """Remove every track"""
+        for track in self._tracks:
+            track.counted_duration = None
+        self._tracks.clear()
+        self._index.clear()
+        self.total_duration = 0
+        self.unknown_durations = 0
+        self.version += 1
+
+    def learn_duration(self, track):
+        """Count the length of a queued track that was unknown when it was added"""
+        if track.counted_duration == 0 and track.duration:
+            track.counted_duration = track.duration
+            self.total_duration += track.duration
+            self.unknown_durations -= 1
+
+    def find(self, video_id):
+        """Return the position of the first copy of a video, or None"""
+        if video_id not in self._index:
             return None
-    
-    return await loop.run_in_executor(None, _extract)
+        for position, track in enumerate(self._tracks):
+            if track.id == video_id:
+                return position
+        return None
+
+
+# Build a queue entry from extracted (or cached) audio information
+def make_track(data):
+    """Create a resolved queue entry"""
+    video_id = data.get('id')
+    return Track(
+        video_id,
+        data.get('title') or 'Unknown song',
+        url=data.get('url'),
+        webpage_url=data.get('webpage_url') or (
+            f"https://www.youtube.com/watch?v={video_id}" if video_id else None),
+        duration=data.get('duration'),
+        codec=data.get('acodec'),
+    )
+
 
-# 🎵 Function to play the next song in queue
-async def play_next_song(guild_id, voice_client, channel, retry_count=0):
-  if guild_id in song_queues and song_queues[
-      guild_id]:  # Check if queue is not empty
-    next_song = song_queues[guild_id].pop(0)
-    song_url = next_song['url']
-    title = next_song['title']
+# Build an unresolved queue entry from flat playlist data
+def make_playlist_track(entry):
+    """Create a queue entry whose stream URL is resolved just before it plays"""
+    return Track(
+        entry['id'],
+        entry.get('title') or f"https://youtu.be/{entry['id']}",
+        webpage_url=f"https://www.youtube.com/watch?v={entry['id']}",
+        duration=entry.get('duration'),
+    )
 
+
+def track_needs_resolve(track):
+    """Check if a track has no stream URL yet or its signed URL is about to expire"""
+    if not track.url:
+        return True
+    expire = get_stream_expiry(track.url)
+    return expire is not None and expire - STREAM_EXPIRY_MARGIN <= time.time()
+
+
+# In-flight resolutions keyed by page URL, so the same video is only extracted once
+pending_resolves = {}
+
+
+async def resolve_track(track, loop, guild_id=None):
+    """Fill in the stream URL of a queued track, returning False if it can't be played"""
+    if not track_needs_resolve(track):
+        return True
+    if not track.webpage_url:
+        return False
+
+    key = track.webpage_url
+    task = pending_resolves.get(key)
+    if task is None:
+        task = loop.create_task(extract_audio_info(key, loop, guild_id))
+        pending_resolves[key] = task
+        task.add_done_callback(lambda _: pending_resolves.pop(key, None))
+
+    # Shield the shared task so one cancelled waiter doesn't cancel it for everyone
+    data = await asyncio.shield(task)
+    if not data or not data.get('url'):
+        return False
+
+    track.url = data['url']
+    track.title = data.get('title') or track.title
+    track.duration = data.get('duration') or track.duration
+    track.codec = data.get('acodec')
+
+    # Keep the queue's cached total in step once a missing length becomes known
+    queue = song_queues.get(guild_id)
+    if queue is not None and track.counted_duration == 0:
+        queue.learn_duration(track)
+    return True
+
+
+def resolve_upcoming(guild_id):
+    """Start resolving the next few queued tracks in the background"""
+    queue = song_queues.get(guild_id)
+    if not queue:
+        return
+    for track in queue.slice(0, RESOLVE_AHEAD):
+        if track_needs_resolve(track):
+            bot.loop.create_task(resolve_track(track, bot.loop, guild_id))
+
+
+# 🔊 Loudness measurements per video
+class LoudnessCache:
+    """Stores integrated loudness and true peak per video ID, in memory and in SQLite"""
+
+    def __init__(self):
+        self.entries = {}  # video_id -> measurement dict (or None when not measured)
+        self.lock = threading.Lock()
+        get_db().execute(
+            'CREATE TABLE IF NOT EXISTS loudness ('
+            'video_id TEXT PRIMARY KEY, measurement TEXT, measured_at REAL)')
+
+    def get(self, video_id):
+        """Return the measurement for a video, or None (may hit SQLite - run off the loop)"""
+        with self.lock:
+            if video_id in self.entries:
+                return self.entries[video_id]
+        rows = get_db().execute('SELECT measurement FROM loudness WHERE video_id = ?', (video_id,))
+        measurement = json.loads(rows[0][0]) if rows else None
+        with self.lock:
+            self.entries[video_id] = measurement
+        return measurement
+
+    def known(self, video_id):
+        """Check the in-memory tier only, without touching the database"""
+        with self.lock:
+            return self.entries.get(video_id) is not None
+
+    def put(self, video_id, measurement):
+        """Store a new measurement (blocking)"""
+        with self.lock:
+            self.entries[video_id] = measurement
+        get_db().execute('INSERT OR REPLACE INTO loudness VALUES (?, ?, ?)',
+                         (video_id, json.dumps(measurement), time.time()))
+
+
+loudness_cache = LoudnessCache() if LOUDNESS_ANALYSIS else None
+
+
+def parse_loudnorm_output(stderr):
+    """Pull the JSON block printed by loudnorm's print_format=json out of ffmpeg's stderr"""
+    start = stderr.rfind('{')
+    end = stderr.rfind('}')
+    if start == -1 or end < start:
+        return None
     try:
-      # ✅ Send a clean Discord message
-      embed = discord.Embed(title=f"🎵 Now Playing: {title}",
-                            description=f"[Listen on YouTube]({song_url})",
-                            color=discord.Color.blue())
-      await channel.send(embed=embed)
-
-      # ✅ Play the song and set an async `after` callback
-      try:
-        player = FFmpegOpusAudio(song_url, **ffmpeg_options)
-        voice_client.play(
-            player,
-            after=lambda e: asyncio.run_coroutine_threadsafe(
-                handle_next_song(guild_id, voice_client, channel, e), bot.loop))
-      except Exception as audio_error:
-        print(f"⚠️ Error creating audio player: {audio_error}")
-        
-        # Retry for transient errors (max 2 retries)
-        if retry_count < 2:
-          print(f"Retrying... Attempt {retry_count + 1}/2")
-          # Put the song back at the front of the queue
-          song_queues[guild_id].insert(0, next_song)
-          await asyncio.sleep(2)  # Wait a bit before retrying
-          await play_next_song(guild_id, voice_client, channel, retry_count + 1)
+        data = json.loads(stderr[start:end + 1])
+        measurement = {
+            'input_i': float(data['input_i']),
+            'input_tp': float(data['input_tp']),
+            'input_lra': float(data['input_lra']),
+            'input_thresh': float(data['input_thresh']),
+            'target_offset': float(data['target_offset']),
+        }
+    except (ValueError, KeyError):
+        return None
+    # Silent tracks report -inf, which can't be turned into a gain
+    if not all(math.isfinite(value) for value in measurement.values()):
+        return None
+    return measurement
+
+
+def loudness_gain(measurement):
+    """Static gain towards the target, without pushing true peaks over the ceiling"""
+    return min(LOUDNESS_TARGET - measurement['input_i'],
+               LOUDNESS_TRUE_PEAK - measurement['input_tp'])
+
+
+def loudness_filter(measurement):
+    """Pick the normalization filter for a track from its cached loudness"""
+    if measurement is None:
+        # Cache miss - fall back to live single-pass normalization
+        return LOUDNORM_FILTER
+    if LOUDNESS_MODE == 'linear':
+        return (f"{LOUDNORM_FILTER}:measured_I={measurement['input_i']}"
+                f":measured_TP={measurement['input_tp']}:measured_LRA={measurement['input_lra']}"
+                f":measured_thresh={measurement['input_thresh']}"
+                f":offset={measurement['target_offset']}:linear=true")
+    return f"volume={loudness_gain(measurement):.2f}dB"
+
+
+def choose_audio_filter(track):
+    """Return the filter a track needs, or None if it can be sent without re-encoding (blocking)"""
+    if PLAYBACK_MODE == 'passthrough':
+        return None
+    measurement = loudness_cache.get(track.id) if loudness_cache and track.id else None
+    if (PLAYBACK_MODE == 'auto' and measurement is not None
+            and abs(loudness_gain(measurement)) <= PASSTHROUGH_GAIN_TOLERANCE):
+        # Already close enough to the target that normalizing wouldn't be audible
+        return None
+    return loudness_filter(measurement)
+
+
+def probe_codec(url):
+    """Ask ffprobe for the codec of the first audio stream (blocking)"""
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_streams',
+             '-select_streams', 'a:0', url],
+            capture_output=True, timeout=20, check=True)
+        streams = json.loads(result.stdout).get('streams') or []
+        return streams[0].get('codec_name') if streams else None
+    except Exception as e:
+        print(f"Error probing codec: {e}")
+        return None
+
+
+class LoudnessAnalyzer:
+    """Measures the loudness of played tracks in the background, a few at a time"""
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.queue = None
+        self.pending = set()
+        self.workers = []
+
+    def request(self, track):
+        """Queue a track for measurement unless it's known or already waiting"""
+        if not track.id or not track.url or track.id in self.pending or loudness_cache.known(track.id):
+            return
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            self.workers = [bot.loop.create_task(self._worker()) for _ in range(self.concurrency)]
+        self.pending.add(track.id)
+        self.queue.put_nowait((track.id, track.url))
+
+    async def _worker(self):
+        while True:
+            video_id, url = await self.queue.get()
+            try:
+                # Another play may have measured it while this one was waiting
+                if await bot.loop.run_in_executor(None, loudness_cache.get, video_id) is None:
+                    measurement = await self.measure(url)
+                    if measurement:
+                        await bot.loop.run_in_executor(None, loudness_cache.put, video_id, measurement)
+                        if os.getenv('DEBUG'):
+                            print(f"Measured loudness of {video_id}: {measurement}")
+            except Exception as e:
+                print(f"Error measuring loudness of {video_id}: {e}")
+            finally:
+                self.pending.discard(video_id)
+
+    async def measure(self, url):
+        """Run a loudnorm analysis pass over a stream with ffmpeg"""
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-hide_banner', '-nostats', '-nostdin',
+            *shlex.split(ffmpeg_options['before_options']),
+            '-i', url, '-vn', '-threads', '1',
+            '-af', f'{LOUDNORM_FILTER}:print_format=json', '-f', 'null', '-',
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            return None
+        return parse_loudnorm_output(stderr.decode(errors='replace'))
+
+
+loudness_analyzer = LoudnessAnalyzer(LOUDNESS_ANALYSIS_CONCURRENCY)
+
+
+# Audio source wrapper that tracks the playback position
+class TrackedAudio(discord.AudioSource):
+    """Counts the frames read by the voice client and can buffer the first one early"""
+
+    FRAME_SECONDS = 0.02  # discord.py reads one 20 ms frame at a time
+
+    def __init__(self, source, start_offset=0.0):
+        self.source = source
+        self.start_offset = start_offset
+        self.frames = 0
+        self.passthrough = False  # True when Opus packets are copied without re-encoding
+        self.encoding = None  # (bitrate, complexity) the source was encoded with
+        self.from_cache = False  # True when played from the local audio cache
+        self.ended = False  # True once the underlying source ran out (as opposed to being stopped)
+        self.broadcast = None  # BroadcastStream this source listens to, in broadcast mode
+        self.read_ahead = None  # ReadAheadAudio between this wrapper and ffmpeg/PyAV, if enabled
+        self._primed = None
+
+    @property
+    def position(self):
+        """Seconds into the track that have been sent to Discord"""
+        return self.start_offset + self.frames * self.FRAME_SECONDS
+
+    def prime(self):
+        """Wait for ffmpeg to connect and produce its first frame (blocking)"""
+        if self._primed is None:
+            self._primed = self.source.read()
+
+    def read(self):
+        if self._primed is not None:
+            data, self._primed = self._primed, None
+        else:
+            data = self.source.read()
+        if data:
+            self.frames += 1
         else:
-          await channel.send(f"⚠️ Failed to play **{title}** after multiple attempts. Skipping.")
-          # Try to play the next song
-          if guild_id in song_queues and song_queues[guild_id]:
-            await play_next_song(guild_id, voice_client, channel)
+            self.ended = True
+        return data
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    @property
+    def _current_error(self):
+        # The voice client hands this to the `after` callback, so an ffmpeg failure isn't taken for a clean end
+        return getattr(self.source, '_current_error', None)
+
+    def cleanup(self):
+        self.source.cleanup()
+
+
+# Read-ahead buffer between the upstream source and the voice client
+class ReadAheadAudio(discord.AudioSource):
+    """Fills a preallocated ring of Opus frames on its own thread, so slow reads upstream don't stall playback"""
+
+    SLOT_BYTES = 1500  # Room for the largest 20 ms Opus packet (1275 bytes)
+
+    def __init__(self, source, depth):
+        self.source = source
+        self.depth = max(2, depth)
+        self.buffer = bytearray(self.SLOT_BYTES * self.depth)
+        self.view = memoryview(self.buffer)
+        self.lengths = [0] * self.depth
+        self.oversized = {}  # slot -> packet too big for its slot (copied instead)
+        self.head = 0  # Slot of the next frame to hand out
+        self.filled = 0  # Slots holding frames that weren't read yet
+        self.finished = False  # The upstream ran out (or failed)
+        self.closed = False
+        self.error = None
+        self.on_eof = None  # Called once, from the fill thread, when the upstream runs out
+        self.frames_read = 0
+        self.underruns = 0
+        self.fill_sum = 0  # Sum of the fill level seen by every read, for the average
+        self.condition = threading.Condition()
+        threading.Thread(target=self._fill, name='read-ahead', daemon=True).start()
+
+    def _fill(self):
+        try:
+            while True:
+                with self.condition:
+                    while self.filled >= self.depth and not self.closed:
+                        self.condition.wait()
+                    if self.closed:
+                        return
+                    slot = (self.head + self.filled) % self.depth
+                data = self.source.read()
+                if not data:
+                    return
+                if len(data) <= self.SLOT_BYTES:
+                    start = slot * self.SLOT_BYTES
+                    self.view[start:start + len(data)] = data
+                else:
+                    self.oversized[slot] = bytes(data)
+                with self.condition:
+                    self.lengths[slot] = len(data)
+                    self.filled += 1
+                    self.condition.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.condition:
+                self.finished = True
+                callback, self.on_eof = self.on_eof, None
+                self.condition.notify_all()
+            if callback and not self.closed:
+                callback()
+
+    def when_drained(self, callback):
+        """Call `callback` once the upstream has run out, i.e. the buffer holds the last frames"""
+        with self.condition:
+            if not self.finished:
+                self.on_eof = callback
+                return
+        callback()
+
+    @property
+    def average_fill(self):
+        return self.fill_sum / self.frames_read if self.frames_read else 0.0
+
+    def read(self):
+        with self.condition:
+            if not self.filled and not self.finished and self.frames_read:
+                self.underruns += 1
+                read_ahead_underruns.inc()
+            while not self.filled and not self.finished:
+                self.condition.wait()
+            if not self.filled:
+                if self.error is not None:
+                    raise self.error
+                return b''
+            self.fill_sum += self.filled
+            self.frames_read += 1
+            slot = self.head
+            data = self.oversized.pop(slot, None)
+            if data is None:
+                # A copy, since the slot is refilled as soon as it is released (and the DAVE encryptor wants bytes)
+                start = slot * self.SLOT_BYTES
+                data = bytes(self.view[start:start + self.lengths[slot]])
+            self.head = (self.head + 1) % self.depth
+            self.filled -= 1
+            self.condition.notify_all()
+            return data
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    @property
+    def _current_error(self):
+        return getattr(self.source, '_current_error', None)
+
+    def cleanup(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.source.cleanup()
+
+
+# 💽 Local cache of ready-to-send Ogg/Opus files
+class CachedOpusAudio(discord.AudioSource):
+    """Plays an Ogg/Opus file from the audio cache without spawning ffmpeg"""
+
+    def __init__(self, path, start_offset=0):
+        self._file = open(path, 'rb')
+        self._packets = OggStream(self._file).iter_packets()
+        # Every packet holds 20 ms of audio, so seeking is just skipping packets
+        for _ in range(int(start_offset / TrackedAudio.FRAME_SECONDS)):
+            if not self._next_packet():
+                break
+
+    def _next_packet(self):
+        for packet in self._packets:
+            # Skip the OpusHead / OpusTags header packets
+            if packet.startswith((b'OpusHead', b'OpusTags')):
+                continue
+            return packet
+        return b''
+
+    def read(self):
+        return self._next_packet()
+
+    def is_opus(self):
+        return True
 
+    def cleanup(self):
+        self._file.close()
+
+
+class AudioCache:
+    """Size-bounded LRU cache of transcoded tracks, filled in the background during the first play"""
+
+    STALE_TEMP_SECONDS = 600  # A fill that hasn't written for this long is dead, even if its pid was reused
+
+    def __init__(self, directory, max_bytes, fill_concurrency):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.files = OrderedDict()  # file name -> size in bytes, least recently used first
+        self.total_bytes = 0
+        self.filling = set()
+        self.lock = threading.Lock()
+        self.fill_semaphore = asyncio.Semaphore(fill_concurrency)
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        """Index the files left by a previous run and remove interrupted writes"""
+        found = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith('.tmp'):
+                # Other shard processes may be filling the same directory - only remove their leftovers
+                if self._is_abandoned(entry):
+                    os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            found.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(found):
+            self.files[name] = size
+            self.total_bytes += size
+        self._evict()
+
+    def _is_abandoned(self, entry):
+        """Check if a temp file's writer (named by the pid in the file name) is gone"""
+        if time.time() - entry.stat().st_mtime > self.STALE_TEMP_SECONDS:
+            return True
+        pid = entry.name[:-len('.tmp')].rsplit('.', 1)[-1]
+        if not pid.isdigit() or os.name == 'nt':
+            return False  # os.kill would terminate the process on Windows - rely on the age alone
+        if int(pid) == os.getpid():
+            return True  # Left by an earlier process that had our pid - we haven't started any fill yet
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass  # Alive, but owned by another user
+        return False
+
+    @staticmethod
+    def file_name(video_id, encoding):
+        return f"{video_id}-{encoding[0]}k.opus"
+
+    def lookup(self, video_id, encoding):
+        """Return the cached file for a track, or None"""
+        if not video_id:
+            return None
+        name = self.file_name(video_id, encoding)
+        with self.lock:
+            if name not in self.files:
+                return None
+            self.files.move_to_end(name)
+        return os.path.join(self.directory, name)
+
+    def open(self, video_id, encoding, start_offset=0):
+        """Open a cached file for playback, or return None on a miss (blocking)"""
+        path = self.lookup(video_id, encoding)
+        if path is None:
+            return None
+        try:
+            # The modification time doubles as the LRU order across restarts
+            os.utime(path)
+            return CachedOpusAudio(path, start_offset)
+        except OSError:
+            self._forget(os.path.basename(path))
+            return None
+
+    def _forget(self, name):
+        with self.lock:
+            size = self.files.pop(name, None)
+            if size is not None:
+                self.total_bytes -= size
+
+    def _add(self, name, size):
+        with self.lock:
+            self.files[name] = size
+            self.total_bytes += size
+        self._evict()
+
+    def _evict(self):
+        """Delete least recently used files until we're under the byte budget"""
+        while True:
+            with self.lock:
+                if self.total_bytes <= self.max_bytes or not self.files:
+                    return
+                name, size = self.files.popitem(last=False)
+                self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError as e:
+                print(f"Error evicting cached audio {name}: {e}")
+
+    async def fill(self, track, encoding):
+        """Transcode a track into the cache next to its first play"""
+        name = self.file_name(track.id, encoding)
+        if name in self.files or name in self.filling:
+            return
+        self.filling.add(name)
+        path = os.path.join(self.directory, name)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            async with self.fill_semaphore:
+                audio_filter = await bot.loop.run_in_executor(None, choose_audio_filter, track)
+                if audio_filter is None and track.codec == 'opus':
+                    codec_args = ['-c:a', 'copy']
+                else:
+                    codec_args = ['-c:a', 'libopus', '-b:a', f'{encoding[0]}k',
+                                  '-compression_level', str(encoding[1]), '-ar', '48000', '-ac', '2']
+                    if audio_filter:
+                        codec_args += ['-filter:a', audio_filter]
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'error', '-y',
+                    *shlex.split(ffmpeg_options['before_options']),
+                    '-i', track.url, '-vn', '-map_metadata', '-1', *codec_args, '-f', 'ogg', temp_path,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+                _, stderr = await process.communicate()
+                if process.returncode != 0:
+                    print(f"Error caching audio for {track.id}: {stderr.decode(errors='replace')[-200:]}")
+                    return
+                size = await bot.loop.run_in_executor(None, self._commit, temp_path, path)
+                self._add(name, size)
+        except Exception as e:
+            print(f"Error caching audio for {track.id}: {e}")
+        finally:
+            self.filling.discard(name)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @staticmethod
+    def _commit(temp_path, path):
+        """Flush the finished file to disk and atomically move it into place (blocking)"""
+        with open(temp_path, 'rb') as file:
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+        return os.path.getsize(path)
+
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_MB * 1024 * 1024,
+                         AUDIO_CACHE_FILL_CONCURRENCY) if AUDIO_CACHE_DIR else None
+
+
+# 🧩 In-process audio backend (PyAV) - no ffmpeg process, no pipe
+OPUS_SET_COMPLEXITY = 4010  # libopus encoder ctl, not exposed by discord.opus.Encoder
+
+
+def set_opus_complexity(encoder, complexity):
+    """Set the complexity of a discord.py Opus encoder"""
+    try:
+        discord.opus._lib.opus_encoder_ctl(encoder._state, OPUS_SET_COMPLEXITY, complexity)
     except Exception as e:
-      print(f"⚠️ Error playing audio: {e}")
-      await channel.send(f"⚠️ Error playing **{title}**")
-      
-      # Try next song if available
-      if guild_id in song_queues and song_queues[guild_id]:
-        await channel.send("Attempting to play next song...")
-        await play_next_song(guild_id, voice_client, channel)
+        print(f"Could not set Opus complexity: {e}")
 
-  else:
-    await channel.send("🎶 The queue is currently empty.")
 
+class PyAVAudio(discord.AudioSource):
+    """Demuxes (and if needed decodes, filters and encodes) a stream in process, yielding 20 ms Opus packets"""
 
-async def handle_next_song(guild_id, voice_client, channel, error=None):
-  await asyncio.sleep(1)  # ✅ Prevent race conditions
-  
-  # Log any errors from the previous song
-  if error:
-    print(f"Error from previous song: {error}")
-    
-  if not voice_client.is_playing() and guild_id in song_queues and song_queues[guild_id]:
-    await play_next_song(guild_id, voice_client, channel)
+    FRAME_SAMPLES = 960  # 20 ms at 48 kHz
+    FRAME_BYTES = FRAME_SAMPLES * 2 * 2  # Stereo, 16 bit
+    OPEN_OPTIONS = {'reconnect': '1', 'reconnect_streamed': '1', 'reconnect_delay_max': '5'}
 
+    def __init__(self, url, start_offset=0, audio_filter=None, bitrate=128, complexity=10):
+        self.lock = threading.Lock()  # Held while reading, so cleanup never closes a container mid-read
+        self.closed = False
+        self.container = None
+        self.container = av.open(url, options=self.OPEN_OPTIONS, timeout=20)
+        try:
+            self._setup(start_offset, audio_filter, bitrate, complexity)
+        except Exception:
+            # No audio stream, a bad filter... - don't leave the connection open
+            self._close()
+            raise
+
+    def _setup(self, start_offset, audio_filter, bitrate, complexity):
+        stream = self.container.streams.audio[0]
+        if start_offset:
+            self.container.seek(int(start_offset * av.time_base))
+        self.packets = self.container.demux(stream)
+
+        # Opus in, Opus out - hand the demuxed packets over as they are
+        self.passthrough = audio_filter is None and stream.codec_context.name == 'opus'
+        self.pcm = bytearray()  # Decoded audio waiting to be encoded, reused for the whole track
+        self.flushed = False
+        self.resampler = self.graph = self.encoder = None
+        if not self.passthrough:
+            self.resampler = av.AudioResampler(format='s16', layout='stereo', rate=48000)
+            if audio_filter:
+                self.graph = self._build_filter(audio_filter)
+            self.encoder = discord.opus.Encoder()
+            self.encoder.set_bitrate(bitrate)
+            set_opus_complexity(self.encoder, complexity)
+            # The frame handed to the encoder, also reused: a ctypes view of it goes straight to libopus
+            self.frame = bytearray(self.FRAME_BYTES)
+            self.frame_pointer = (ctypes.c_char * self.FRAME_BYTES).from_buffer(self.frame)
+
+    def _build_filter(self, audio_filter):
+        graph = av.filter.Graph()
+        name, _, args = audio_filter.partition('=')
+        chain = [
+            graph.add_abuffer(format='s16', layout='stereo', sample_rate=48000),
+            graph.add(name, args),
+            # loudnorm works at 192 kHz internally - bring it back to what Discord wants
+            graph.add('aresample', '48000'),
+            graph.add('aformat', 'sample_fmts=s16:channel_layouts=stereo'),
+            graph.add('abuffersink'),
+        ]
+        for upstream, downstream in zip(chain, chain[1:]):
+            upstream.link_to(downstream)
+        graph.configure()
+        return graph
+
+    def _append(self, frame):
+        if self.graph is None:
+            self.pcm.extend(memoryview(frame.planes[0])[:frame.samples * 4])
+            return
+        self.graph.push(frame)
+        self._drain_filter()
+
+    def _drain_filter(self):
+        while True:
+            try:
+                filtered = self.graph.pull()
+            except (BlockingIOError, EOFError):
+                return
+            self.pcm.extend(memoryview(filtered.planes[0])[:filtered.samples * 4])
+
+    def _decode_more(self):
+        """Decode one more packet into the PCM buffer, returning False at the end of the stream"""
+        for packet in self.packets:
+            for frame in packet.decode():
+                for resampled in self.resampler.resample(frame):
+                    self._append(resampled)
+            return True
+        if not self.flushed:
+            self.flushed = True
+            for resampled in self.resampler.resample(None):
+                self._append(resampled)
+            if self.graph is not None:
+                # loudnorm holds back a few seconds of audio - end the stream so it hands them over
+                self.graph.push(None)
+                self._drain_filter()
+            return True
+        return False
+
+    def _read(self):
+        if self.passthrough:
+            for packet in self.packets:
+                if packet.size:
+                    return bytes(packet)
+            return b''
+        while len(self.pcm) < self.FRAME_BYTES:
+            if not self._decode_more():
+                if not self.pcm:
+                    return b''
+                self.pcm.extend(bytes(self.FRAME_BYTES - len(self.pcm)))  # Pad the last frame with silence
+        with memoryview(self.pcm) as view:
+            self.frame[:] = view[:self.FRAME_BYTES]
+        del self.pcm[:self.FRAME_BYTES]
+        return self.encoder.encode(self.frame_pointer, self.FRAME_SAMPLES)
+
+    def read(self):
+        with self.lock:
+            if self.closed:
+                self._close()
+                return b''
+            return self._read()
+
+    def is_opus(self):
+        return True
+
+    def _close(self):
+        if self.container is not None:
+            self.container.close()
+            self.container = None
+
+    def cleanup(self):
+        self.closed = True
+        # If a read is in progress, it closes the container when it is done
+        if self.lock.acquire(blocking=False):
+            try:
+                self._close()
+            finally:
+                self.lock.release()
+
+
+def open_audio_source(track, start_offset=0, encoding=None):
+    """Spawn ffmpeg for a track and wait until it has audio ready (blocking)"""
+    bitrate, complexity = encoding or encoding_for(None)
+
+    # Replays of cached tracks need neither the network nor ffmpeg
+    if audio_cache:
+        cached = audio_cache.open(track.id, (bitrate, complexity), start_offset)
+        if cached is not None:
+            source = TrackedAudio(cached, start_offset)
+            source.encoding = (bitrate, complexity)
+            source.from_cache = True
+            source.prime()
+            return source
+    audio_filter = choose_audio_filter(track)
+    if AUDIO_BACKEND == 'pyav':
+        # PyAV sees the codec itself, so no ffprobe run is needed
+        started = time.perf_counter()
+        audio = PyAVAudio(track.url, start_offset, audio_filter, bitrate, complexity)
+        return finish_audio_source(audio, start_offset, (bitrate, complexity), audio.passthrough, started)
+
+    options = dict(ffmpeg_options)
+    if start_offset:
+        options['before_options'] = f"{options['before_options']} -ss {start_offset:.2f}"
+    codec = track.codec
+    if audio_filter is None and not codec:
+        codec = track.codec = probe_codec(track.url)
+
+    started = time.perf_counter()
+    if audio_filter is None and codec == 'opus':
+        # Opus in, Opus out - copy the packets instead of decoding and re-encoding
+        options['options'] = '-vn'
+        audio = FFmpegOpusAudio(track.url, codec='opus', **options)
+    else:
+        options['options'] = f'{options["options"]} -compression_level {complexity}'
+        if audio_filter:
+            options['options'] = f'{options["options"]} -filter:a "{audio_filter}"'
+        audio = FFmpegOpusAudio(track.url, bitrate=bitrate, **options)
+    return finish_audio_source(audio, start_offset, (bitrate, complexity),
+                               audio_filter is None and codec == 'opus', started)
+
+
+def finish_audio_source(audio, start_offset, encoding, passthrough, started):
+    """Wrap a freshly opened source, wait for its first frame and record how long that took"""
+    spawned = time.perf_counter()
+    read_ahead = ReadAheadAudio(audio, READ_AHEAD_FRAMES) if READ_AHEAD_FRAMES else None
+    source = TrackedAudio(read_ahead or audio, start_offset)
+    source.read_ahead = read_ahead
+    source.encoding = encoding
+    source.passthrough = passthrough
+    source.prime()
+    audio_source_seconds.observe(spawned - started, stage='spawn')
+    audio_source_seconds.observe(time.perf_counter() - started, stage='first_frame')
+    return source
+
+
+# 📡 Broadcast mode - one ffmpeg per track, shared by every server playing it
+class BroadcastStream:
+    """Reads one upstream source in real time into a ring of Opus frames that many listeners follow"""
+
+    def __init__(self, key, upstream, buffer_seconds):
+        self.key = key
+        self.upstream = upstream
+        self.capacity = max(1, int(buffer_seconds / TrackedAudio.FRAME_SECONDS))
+        self.frames = [None] * self.capacity  # frame with sequence number n is at n % capacity
+        self.next_seq = 0  # Sequence number of the next frame to be produced
+        self.listeners = set()
+        self.finished = False
+        self.condition = threading.Condition()
+
+    @property
+    def live_position(self):
+        """Track position of the newest frame"""
+        return self.upstream.start_offset + self.next_seq * TrackedAudio.FRAME_SECONDS
+
+    def start(self):
+        threading.Thread(target=self._pump, name=f'broadcast-{self.key[0]}', daemon=True).start()
+
+    def _pump(self):
+        # Pace the upstream like a voice client would, so listeners stay at the live edge
+        next_frame = time.perf_counter()
+        try:
+            while self.listeners:
+                data = self.upstream.read()
+                if not data:
+                    break
+                data = bytes(data)  # Read-ahead frames are views into a buffer that gets reused
+                with self.condition:
+                    self.frames[self.next_seq % self.capacity] = data
+                    self.next_seq += 1
+                    self.condition.notify_all()
+                next_frame += TrackedAudio.FRAME_SECONDS
+                time.sleep(max(0.0, next_frame - time.perf_counter()))
+        except Exception as e:
+            print(f"Broadcast of {self.key[0]} failed: {e}")
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+            with broadcasts_lock:
+                if broadcasts.get(self.key) is self:
+                    del broadcasts[self.key]
+            self.upstream.cleanup()
+
+    def attach(self):
+        """Add a listener that starts at the live edge"""
+        listener = BroadcastListener(self)
+        with self.condition:
+            self.listeners.add(listener)
+        return listener
+
+    def detach(self, listener):
+        with self.condition:
+            self.listeners.discard(listener)
+
+    def read(self, cursor):
+        """Return (frame, next cursor) for a listener, waiting for the frame if needed"""
+        with self.condition:
+            while cursor >= self.next_seq and not self.finished:
+                self.condition.wait(timeout=1)
+            if cursor >= self.next_seq:
+                return b'', cursor
+            if cursor < self.next_seq - self.capacity:
+                # Fell out of the buffer (e.g. paused) - catch up with the live edge
+                cursor = self.next_seq - 1
+            return self.frames[cursor % self.capacity], cursor + 1
+
+
+class BroadcastListener(discord.AudioSource):
+    """One server's view of a BroadcastStream, following it at its own cursor"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.cursor = stream.next_seq
+
+    def read(self):
+        data, self.cursor = self.stream.read(self.cursor)
+        return data
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.stream.detach(self)
+
+
+broadcasts = {}  # (video_id, encoding) -> BroadcastStream
+broadcasts_lock = threading.Lock()
+
+
+def open_broadcast_source(track, start_offset=0, encoding=None):
+    """Join the live broadcast of a track, starting one if none is running (blocking)"""
+    encoding = encoding or encoding_for(None)
+    key = (track.id, encoding)
+    with broadcasts_lock:
+        stream = broadcasts.get(key)
+        listener = stream.attach() if stream and not stream.finished else None
+
+    if listener is None:
+        upstream = open_audio_source(track, start_offset, encoding)
+        with broadcasts_lock:
+            stream = broadcasts.get(key)
+            if stream and not stream.finished:
+                # Another server started the same broadcast while ffmpeg was spawning
+                upstream.cleanup()
+                listener = stream.attach()
+            else:
+                stream = broadcasts[key] = BroadcastStream(key, upstream, BROADCAST_BUFFER_SECONDS)
+                listener = stream.attach()
+                stream.start()
+
+    source = TrackedAudio(listener, stream.live_position)
+    source.encoding = stream.upstream.encoding
+    source.passthrough = stream.upstream.passthrough
+    source.from_cache = stream.upstream.from_cache
+    source.broadcast = stream
+    source.prime()
+    return source
+
+
+def is_broadcasting(guild_id):
+    """Check if a server plays in broadcast mode"""
+    return get_guild_setting(guild_id, 'broadcast', BROADCAST_DEFAULT)
+
+
+# 🎚️ Per-guild settings, kept in memory and mirrored to SQLite
+guild_settings = {}  # guild_id -> {setting: value}
+
+
+def load_guild_settings():
+    """Read every saved guild setting (blocking)"""
+    db = get_db()
+    db.execute('CREATE TABLE IF NOT EXISTS guild_settings ('
+               'guild_id INTEGER, key TEXT, value TEXT, PRIMARY KEY (guild_id, key))')
+    for guild_id, key, value in db.execute('SELECT guild_id, key, value FROM guild_settings'):
+        guild_settings.setdefault(guild_id, {})[key] = json.loads(value)
+
+
+def get_guild_setting(guild_id, key, default=None):
+    """Return a guild's setting, or the default if it was never changed"""
+    return guild_settings.get(guild_id, {}).get(key, default)
+
+
+async def set_guild_setting(guild_id, key, value):
+    """Change a guild setting and save it without blocking the event loop"""
+    guild_settings.setdefault(guild_id, {})[key] = value
+    await bot.loop.run_in_executor(
+        None, get_db().execute, 'INSERT OR REPLACE INTO guild_settings VALUES (?, ?, ?)',
+        (guild_id, key, json.dumps(value)))
+
+
+load_guild_settings()
+
+
+def encoding_for(guild_id):
+    """Work out (bitrate in kbps, opus complexity) for the channel a guild is playing in"""
+    profile = ENCODE_PROFILES.get(
+        get_guild_setting(guild_id, 'encode_profile', DEFAULT_ENCODE_PROFILE),
+        ENCODE_PROFILES['balanced'])
+    bitrate = profile['max_bitrate']
+    voice_client = voice_clients.get(guild_id)
+    channel = getattr(voice_client, 'channel', None)
+    if channel is not None and getattr(channel, 'bitrate', None):
+        # Anything above the channel bitrate is thrown away by Discord
+        bitrate = min(bitrate, channel.bitrate // 1000)
+    return max(bitrate, 8), profile['complexity']
+
+
+def is_audio_cached(guild_id, track):
+    """Check if a track can be played from the local audio cache"""
+    return bool(audio_cache and audio_cache.lookup(track.id, encoding_for(guild_id)))
+
+
+def retarget_encoding(guild_id):
+    """Have the guild's player restart the current track at the new channel bitrate"""
+    player = guild_players.get(guild_id)
+    if player is not None:
+        player.post('retarget')
+
+
+# 📨 Outbound channel messages
+class MessageScheduler:
+    """Per-channel send queue that respects the rate limit, coalesces edits and lets commands go first"""
+
+    PRIORITY_MESSAGE = 0  # Errors and notices
+    PRIORITY_COSMETIC = 1  # Now-playing updates and other edits
+
+    def __init__(self, rate, period, debounce, interaction_grace):
+        self.rate = rate
+        self.period = period
+        self.debounce = debounce
+        self.interaction_grace = interaction_grace
+        self.jobs = {}  # channel_id -> OrderedDict of key -> [priority, ready_at, send, future]
+        self.history = {}  # channel_id -> deque of monotonic send times within the last period
+        self.workers = {}  # channel_id -> asyncio.Task
+        self.wakeups = {}  # channel_id -> asyncio.Event
+        self.quiet_until = {}  # channel_id -> monotonic time until which cosmetic updates wait
+        self.now_playing_messages = {}  # guild_id -> discord.Message
+        self._counter = 0
+
+    @property
+    def pending(self):
+        """Messages and edits waiting to be sent"""
+        return sum(len(jobs) for jobs in self.jobs.values())
+
+    def send(self, channel, content=None, **kwargs):
+        """Queue a message for a channel and return a future with the sent message"""
+        self._counter += 1
+        return self._submit(channel, ('message', self._counter), self.PRIORITY_MESSAGE, 0,
+                            partial(channel.send, content, **kwargs))
+
+    def edit(self, message, **fields):
+        """Queue an edit, replacing any edit of the same message that hasn't been sent yet"""
+        return self._submit(message.channel, ('edit', message.id), self.PRIORITY_COSMETIC, 0,
+                            partial(message.edit, **fields))
 
-# Helper function to print format information
-def print_format_info(info_dict):
-    """Print detailed format information from yt-dlp results"""
-    # Only run if debug mode is enabled
-    if not os.getenv('DEBUG'):
+    def now_playing(self, guild_id, channel, embed):
+        """Show what's playing, editing the guild's last now-playing message while it's the newest one"""
+        async def update():
+            message = self.now_playing_messages.get(guild_id)
+            if (message is not None and message.channel.id == channel.id
+                    and getattr(channel, 'last_message_id', None) == message.id):
+                try:
+                    message = await message.edit(embed=embed)
+                    self.now_playing_messages[guild_id] = message
+                    return message
+                except discord.NotFound:
+                    pass
+            message = await channel.send(embed=embed)
+            self.now_playing_messages[guild_id] = message
+            return message
+
+        return self._submit(channel, ('now_playing', guild_id), self.PRIORITY_COSMETIC, self.debounce, update)
+
+    def hold(self, channel_id):
+        """Keep cosmetic updates out of the way of a command that was just used in a channel"""
+        if channel_id is not None:
+            self.quiet_until[channel_id] = time.monotonic() + self.interaction_grace
+
+    def forget(self, guild_id):
+        """Drop the remembered now-playing message of a guild"""
+        self.now_playing_messages.pop(guild_id, None)
+
+    def _submit(self, channel, key, priority, delay, send):
+        jobs = self.jobs.setdefault(channel.id, OrderedDict())
+        previous = jobs.pop(key, None)
+        if previous:
+            # Send only the newest version, at the time the first one was due
+            messages_coalesced.inc()
+            future, ready_at = previous[3], previous[1]
+        else:
+            future, ready_at = asyncio.get_running_loop().create_future(), time.monotonic() + delay
+        jobs[key] = [priority, ready_at, send, future]
+        if channel.id in self.workers:
+            self.wakeups[channel.id].set()
+        else:
+            self.wakeups[channel.id] = asyncio.Event()
+            self.workers[channel.id] = bot.loop.create_task(self._run(channel.id))
+        return future
+
+    def _next_time(self, channel_id, job):
+        if job[0] == self.PRIORITY_COSMETIC:
+            return max(job[1], self.quiet_until.get(channel_id, 0))
+        return job[1]
+
+    async def _run(self, channel_id):
+        jobs = self.jobs[channel_id]
+        history = self.history.setdefault(channel_id, deque())
+        wakeup = self.wakeups[channel_id]
+        while jobs:
+            now = time.monotonic()
+            while history and history[0] <= now - self.period:
+                history.popleft()
+            # Highest priority job that is due, oldest first
+            ready = [(job[0], index, key) for index, (key, job) in enumerate(jobs.items())
+                     if self._next_time(channel_id, job) <= now]
+            if ready and len(history) < self.rate:
+                _, _, key = min(ready)
+                _, _, send, future = jobs.pop(key)
+                history.append(now)
+                try:
+                    result = await send()
+                    if not future.done():
+                        future.set_result(result)
+                except Exception as e:
+                    print(f"Error sending message to channel {channel_id}: {e}")
+                    if not future.done():
+                        future.set_result(None)
+                continue
+
+            # Sleep until a job is due, the rate limit frees up or something new is queued
+            wake_at = min(self._next_time(channel_id, job) for job in jobs.values())
+            if ready:
+                wake_at = history[0] + self.period
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), max(0.0, wake_at - now))
+            except asyncio.TimeoutError:
+                pass
+        del self.workers[channel_id]
+        del self.wakeups[channel_id]
+        del self.jobs[channel_id]
+        self.quiet_until.pop(channel_id, None)
+
+
+message_scheduler = MessageScheduler(MESSAGE_RATE, MESSAGE_RATE_PERIOD, NOW_PLAYING_DEBOUNCE, INTERACTION_GRACE)
+
+
+# Seconds before the end of a track at which the next one gets its ffmpeg process
+PREFETCH_WINDOW = int(os.getenv('PREFETCH_WINDOW', '15'))
+
+# Per guild playback state for gapless handoff
+now_playing = {}  # guild_id -> {'track': ..., 'source': TrackedAudio}
+prefetched = {}  # guild_id -> {'track': ..., 'source': TrackedAudio}
+prefetch_tasks = {}  # guild_id -> asyncio.Task
+track_ended_at = {}  # guild_id -> perf_counter() when the previous track finished
+track_gaps = {}  # guild_id -> deque of recent inter-track gaps in seconds
+text_channels = {}  # guild_id -> channel that playback messages go to
+
+
+def discard_prefetch(guild_id):
+    """Drop a prefetched source and stop its ffmpeg process"""
+    entry = prefetched.pop(guild_id, None)
+    if entry:
+        entry['source'].cleanup()
+
+
+def take_prefetched(guild_id, track):
+    """Return the pre-opened source for a track, if the prefetch is still valid"""
+    entry = prefetched.get(guild_id)
+    if (entry and entry['track'] is track and entry['offset'] == track.resume_at
+            and entry['encoding'] == encoding_for(guild_id)):
+        del prefetched[guild_id]
+        return entry['source']
+    # The queue or the channel changed since the prefetch (skip, remove, clear, move, resume...)
+    discard_prefetch(guild_id)
+    return None
+
+
+def record_track_gap(guild_id):
+    """Store how long the voice channel was silent between two tracks"""
+    ended_at = track_ended_at.pop(guild_id, None)
+    if ended_at is None:
         return
-        
-    # Check if info_dict is None
-    if info_dict is None:
-        print("No info dictionary provided to print_format_info")
+    gap = time.perf_counter() - ended_at
+    track_gaps.setdefault(guild_id, deque(maxlen=50)).append(gap)
+    track_gap_seconds.observe(gap)
+    if os.getenv('DEBUG'):
+        print(f"Inter-track gap in guild {guild_id}: {gap * 1000:.0f} ms")
+
+
+# Interactions waiting for their first audio, for the time-to-first-audio metric
+first_audio_requests = {}  # guild_id -> interaction.created_at
+
+
+def record_first_audio(guild_id):
+    """Observe how long it took from the command to audio starting"""
+    requested_at = first_audio_requests.pop(guild_id, None)
+    if requested_at is not None:
+        time_to_first_audio.observe((discord.utils.utcnow() - requested_at).total_seconds())
+
+
+def schedule_prefetch(guild_id, immediate=False):
+    """(Re)start the prefetch task for the song after the current one"""
+    current = now_playing.get(guild_id)
+    if current is None or is_broadcasting(guild_id):
+        return  # Broadcasts are joined when the track starts, not opened ahead
+    task = prefetch_tasks.get(guild_id)
+    if task and not task.done():
+        task.cancel()
+    prefetch_tasks[guild_id] = bot.loop.create_task(prefetch_next_song(guild_id, current, immediate))
+
+
+async def prefetch_next_song(guild_id, current, immediate=False):
+    """Resolve the next queued song and open its audio source before the current one ends"""
+    try:
+        # Wait until we're close to the end, re-checking in case playback was paused
+        duration = current['track'].duration
+        if not immediate and not duration:
+            return
+        while not immediate and now_playing.get(guild_id) is current:
+            remaining = duration - current['source'].position
+            if remaining <= PREFETCH_WINDOW:
+                break
+            await asyncio.sleep(remaining - PREFETCH_WINDOW)
+
+        queue = song_queues.get(guild_id)
+        if now_playing.get(guild_id) is not current or not queue:
+            return
+        track = queue[0]
+        entry = prefetched.get(guild_id)
+        if entry and entry['track'] is track and entry['offset'] == track.resume_at:
+            return
+
+        # A track that was queued again after an interruption starts where it left off
+        offset, encoding = track.resume_at, encoding_for(guild_id)
+        if not is_audio_cached(guild_id, track) and not await resolve_track(track, bot.loop, guild_id):
+            return
+        source = await bot.loop.run_in_executor(None, open_audio_source, track, offset, encoding)
+
+        # The queue may have changed while ffmpeg was starting
+        queue = song_queues.get(guild_id)
+        if now_playing.get(guild_id) is not current or not queue or queue[0] is not track:
+            source.cleanup()
+            return
+        discard_prefetch(guild_id)
+        prefetched[guild_id] = {'track': track, 'source': source, 'offset': offset, 'encoding': encoding}
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Error prefetching next song: {e}")
+
+
+# 🎵 One player task per guild - the only place playback is started or stopped
+class GuildPlayer:
+    """Works through a guild's inbox of commands and playback events one at a time"""
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.inbox = asyncio.Queue()
+        self.channel = None  # Where playback messages go
+        self.retry = None  # (asyncio.TimerHandle, track) while a failed start waits for its retry
+        self.throttled = False  # Users were told playback waits for the extraction circuit breaker
+        self.task = bot.loop.create_task(self.run())
+
+    @property
+    def voice_client(self):
+        return voice_clients.get(self.guild_id)
+
+    def post(self, kind, **data):
+        """Queue a command or event: 'enqueue', 'clear', 'remove', 'shuffle', 'move', 'skip',
+        'track_ended', 'retry', 'draining', 'retarget' or 'stop'"""
+        self.inbox.put_nowait((kind, data))
+
+    async def request(self, kind, **data):
+        """Post a queue command and wait for the player to apply it, returning its result"""
+        reply = bot.loop.create_future()
+        self.post(kind, reply=reply, **data)
+        return await reply
+
+    @staticmethod
+    def answer(reply, result):
+        if reply is not None and not reply.done():
+            reply.set_result(result)
+
+    async def run(self):
+        while True:
+            kind, data = await self.inbox.get()
+            if kind == 'stop':
+                if self.retry:
+                    self.retry[0].cancel()
+                return
+            reply = data.pop('reply', None)
+            try:
+                # Queue changes are answered right away, before a track is started
+                if kind == 'enqueue':
+                    self.answer(reply, self.on_add(data['tracks'], data.get('skip_duplicates', False)))
+                    await self.on_enqueue(data['channel'])
+                elif kind == 'clear':
+                    self.answer(reply, self.on_clear())
+                elif kind == 'remove':
+                    self.answer(reply, self.on_remove(data['index'], data['length']))
+                elif kind == 'shuffle':
+                    self.answer(reply, self.on_shuffle())
+                elif kind == 'move':
+                    self.answer(reply, self.on_move(data['index'], data['position']))
+                elif kind == 'skip':
+                    await self.on_skip()
+                elif kind == 'track_ended':
+                    await self.on_track_ended(data['source'], data['error'])
+                elif kind == 'retry':
+                    await self.on_retry(data['track'], data['attempt'])
+                elif kind == 'draining':
+                    self.on_draining(data['source'])
+                elif kind == 'retarget':
+                    self.on_retarget()
+            except Exception as e:
+                print(f"⚠️ Error in the player of guild {self.guild_id} ({kind}): {e}")
+                if reply is not None and not reply.done():
+                    reply.set_exception(e)
+
+    def say(self, text):
+        """Send a notice to the guild's playback channel"""
+        if self.channel is not None:
+            message_scheduler.send(self.channel, text)
+
+    def is_active(self):
+        """Check if a track is playing, paused or waiting for a retry"""
+        voice_client = self.voice_client
+        return (self.retry is not None or voice_client is None
+                or voice_client.is_playing() or voice_client.is_paused())
+
+    def on_add(self, tracks, skip_duplicates):
+        queue = song_queues.setdefault(self.guild_id, SongQueue())
+        if skip_duplicates:
+            # Leave out videos that are already queued (or repeated in the new tracks)
+            seen = set()
+            unique = []
+            for track in tracks:
+                if track.id not in queue and track.id not in seen:
+                    seen.add(track.id)
+                    unique.append(track)
+            tracks = unique
+        queue.extend(tracks)
+        return len(tracks)
+
+    def on_clear(self):
+        queue = song_queues.get(self.guild_id)
+        if not queue:
+            return 0
+        count = len(queue)
+        queue.clear()
+        return count
+
+    def on_remove(self, index, length):
+        """Remove up to `length` tracks from `index`, returning them and the queue length before"""
+        queue = song_queues.get(self.guild_id) or SongQueue()
+        queue_length = len(queue)
+        if index >= queue_length:
+            return [], queue_length
+        removed = queue.remove_range(index, min(length, queue_length - index))
+        resolve_upcoming(self.guild_id)
+        return removed, queue_length
+
+    def on_shuffle(self):
+        queue = song_queues.get(self.guild_id)
+        if not queue:
+            return 0
+        queue.shuffle()
+        resolve_upcoming(self.guild_id)
+        return len(queue)
+
+    def on_move(self, index, position):
+        """Move a track, returning it (None if the index is out of range), its new position and the queue length"""
+        queue = song_queues.get(self.guild_id) or SongQueue()
+        queue_length = len(queue)
+        if index >= queue_length:
+            return None, position, queue_length
+        position = min(position, queue_length - 1)
+        track = queue.move(index, position)
+        resolve_upcoming(self.guild_id)
+        return track, position, queue_length
+
+    async def on_enqueue(self, channel):
+        self.channel = channel or self.channel
+        if self.is_active():
+            resolve_upcoming(self.guild_id)
+            schedule_prefetch(self.guild_id)
+        else:
+            await self.start_next()
+
+    async def on_skip(self):
+        if self.retry:
+            # Give up on the track that is waiting for its retry
+            handle, track = self.retry
+            handle.cancel()
+            self.retry = None
+            queue = song_queues.get(self.guild_id)
+            if queue and queue[0] is track:
+                queue.popleft()
+            await self.start_next()
+            return
+        voice_client = self.voice_client
+        if voice_client and (voice_client.is_playing() or voice_client.is_paused()):
+            voice_client.stop()  # The `after` callback posts 'track_ended'
+
+    async def on_track_ended(self, source, error):
+        if error:
+            print(f"Error from previous song: {error}")
+        current = now_playing.get(self.guild_id)
+        voice_client = self.voice_client
+        if current is None or current['source'] is not source or voice_client is None:
+            return  # The guild was left, or this track was already replaced
+        if voice_client.is_playing():
+            return
+        del now_playing[self.guild_id]
+
+        # Pick a track that was cut off by a dead stream or a dropped connection back up
+        if was_interrupted(current, voice_client, error):
+            if await resume_interrupted(self.guild_id, voice_client, self.channel, current) is None:
+                return
+
+        if song_queues.get(self.guild_id):
+            await self.start_next()
+        else:
+            track_ended_at.pop(self.guild_id, None)
+            update_idle_timer(self.guild_id)
+
+    def on_retarget(self):
+        # Restart the current track at the new channel bitrate, from where it is now
+        guild_id = self.guild_id
+        discard_prefetch(guild_id)
+        current = now_playing.get(guild_id)
+        voice_client = self.voice_client
+        if not current or not voice_client or not voice_client.is_playing():
+            return
+        source = current['source']
+        if source.passthrough or source.encoding == encoding_for(guild_id):
+            return
+        print(f"Re-targeting encoding in guild {guild_id} to {encoding_for(guild_id)}")
+        track = current['track']
+        track.resume_at = source.position
+        song_queues.setdefault(guild_id, SongQueue()).appendleft(track)
+        voice_client.stop()  # The `after` callback posts 'track_ended', which picks the track back up at resume_at
+
+    def on_draining(self, source):
+        # The upstream ended, so only the read-ahead buffer is left - get the next track ready now
+        current = now_playing.get(self.guild_id)
+        if current is not None and current['source'] is source and self.guild_id not in prefetched:
+            schedule_prefetch(self.guild_id, immediate=True)
+
+    async def on_retry(self, track, attempt):
+        if self.retry is None or self.retry[1] is not track:
+            return  # Skipped or left while waiting
+        self.retry = None
+        queue = song_queues.get(self.guild_id)
+        await self.start_next(attempt if queue and queue[0] is track else 0)
+
+    def schedule_retry(self, track, attempt):
+        """Put a track that failed to start back in front and try it again after a backoff"""
+        playback_retries.inc()
+        delay = PLAY_RETRY_BACKOFF * 2 ** (attempt - 1)
+        delay += random.uniform(0, delay / 2)  # Jitter, so guilds hit by one outage don't retry in lockstep
+        print(f"Retrying {track.title} in guild {self.guild_id} in {delay:.1f}s "
+              f"(attempt {attempt}/{PLAY_RETRIES})")
+        song_queues.setdefault(self.guild_id, SongQueue()).appendleft(track)
+        handle = bot.loop.call_later(delay, partial(self.post, 'retry', track=track, attempt=attempt))
+        self.retry = (handle, track)
+
+    def wait_for_extractions(self, track, attempt):
+        """Put a track back in front and try it again once the circuit breaker lets extractions through"""
+        if not self.throttled:
+            self.throttled = True
+            self.say(f"⏳ {extraction_breaker.describe()} **{track.title}** will start as soon as it can.")
+        song_queues.setdefault(self.guild_id, SongQueue()).appendleft(track)
+        delay = extraction_breaker.retry_after + random.uniform(1, 5)  # Jitter, so guilds don't all probe at once
+        handle = bot.loop.call_later(delay, partial(self.post, 'retry', track=track, attempt=attempt))
+        self.retry = (handle, track)
+
+    async def start_next(self, attempt=0):
+        """Start the next track that can be played, skipping the ones that can't"""
+        guild_id = self.guild_id
+        while True:
+            voice_client = self.voice_client
+            if voice_client is None or voice_client.is_playing() or voice_client.is_paused():
+                return
+            queue = song_queues.get(guild_id)
+            if not queue:
+                update_idle_timer(guild_id)
+                self.say("🎶 The queue is currently empty.")
+                return
+
+            track = queue.popleft()
+            source = take_prefetched(guild_id, track)
+
+            # Playlist entries are only resolved when they reach the head of the queue
+            if (source is None and not is_audio_cached(guild_id, track)
+                    and not await resolve_track(track, bot.loop, guild_id)):
+                reason = unavailable_videos.get(track.id, count=False)
+                if reason is None and extraction_breaker.state != 'closed':
+                    # Nothing is wrong with the track itself - wait instead of skipping through the queue
+                    self.wait_for_extractions(track, attempt)
+                    return
+                playback_failures.inc()
+                if reason:
+                    self.say(f"⚠️ Could not load **{track.title}** ({reason}). Skipping.")
+                else:
+                    self.say(f"⚠️ Could not load **{track.title}**. Skipping.")
+                attempt = 0
+                continue
+
+            try:
+                if source is None:
+                    opener = open_broadcast_source if is_broadcasting(guild_id) else open_audio_source
+                    source = await bot.loop.run_in_executor(
+                        None, opener, track, track.resume_at, encoding_for(guild_id))
+                # The guild may have been left while ffmpeg was starting
+                if self.voice_client is not voice_client or guild_players.get(guild_id) is not self:
+                    source.cleanup()
+                    return
+                voice_client.play(source, after=partial(self.track_ended, source))
+            except Exception as e:
+                print(f"⚠️ Error creating audio player: {e}")
+                if source is not None:
+                    source.cleanup()
+                if attempt < PLAY_RETRIES:
+                    # The stream URL may have expired - resolve it again, keeping resume_at
+                    if track.url:
+                        track.url = None
+                        await bot.loop.run_in_executor(None, stream_cache.invalidate, track.id)
+                    self.schedule_retry(track, attempt + 1)
+                    return
+                playback_failures.inc()
+                self.say(f"⚠️ Failed to play **{track.title}** after multiple attempts. Skipping.")
+                attempt = 0
+                continue
+
+            self.started(track, source)
+            return
+
+    def track_ended(self, source, error):
+        """`after` callback - runs on the audio thread"""
+        track_ended_at[self.guild_id] = time.perf_counter()
+        bot.loop.call_soon_threadsafe(partial(self.post, 'track_ended', source=source, error=error))
+
+    def started(self, track, source):
+        """Bookkeeping once a track's audio is flowing"""
+        guild_id = self.guild_id
+        record_track_gap(guild_id)
+        record_first_audio(guild_id)
+        track.resume_at = 0
+        self.throttled = False
+        now_playing[guild_id] = {'track': track, 'source': source}
+        bot.loop.run_in_executor(None, search_index.record_play, track.id, track.title)
+        text_channels[guild_id] = self.channel
+        update_idle_timer(guild_id)
+
+        # Get the next few songs ready while this one plays
+        resolve_upcoming(guild_id)
+        schedule_prefetch(guild_id)
+        if source.read_ahead:
+            # Also when the stream ends sooner than its duration says (or has none)
+            source.read_ahead.when_drained(
+                partial(bot.loop.call_soon_threadsafe, partial(self.post, 'draining', source=source)))
+
+        # Measure loudness in the background so later plays skip live normalization
+        if loudness_cache and not source.from_cache:
+            loudness_analyzer.request(track)
+
+        # Keep a local copy of the track so replays start instantly
+        if (audio_cache and not source.from_cache and track.id and track.url
+                and track.duration and track.duration <= AUDIO_CACHE_MAX_DURATION):
+            bot.loop.create_task(audio_cache.fill(track, source.encoding or encoding_for(guild_id)))
+
+        # ✅ Update the now-playing message once the audio is already flowing
+        if self.channel is not None:
+            embed = discord.Embed(title=f"🎵 Now Playing: {track.title}",
+                                  description=f"[Listen on YouTube]({track.webpage_url or track.url})",
+                                  color=discord.Color.blue())
+            message_scheduler.now_playing(guild_id, self.channel, embed)
+
+
+guild_players = {}  # guild_id -> GuildPlayer
+
+
+def get_player(guild_id):
+    """Return the guild's player task, starting it if needed"""
+    player = guild_players.get(guild_id)
+    if player is None:
+        player = guild_players[guild_id] = GuildPlayer(guild_id)
+    return player
+
+
+# Tracks this close to their end count as finished, not interrupted
+RESUME_MIN_REMAINING = 5
+# Playing this long after a resume means the stream recovered, so the attempt count starts over
+RESUME_PROGRESS_RESET = 30
+
+reconnecting_guilds = set()  # Guilds whose voice connection is being re-established by the bot
+
+
+def was_interrupted(current, voice_client, error):
+    """Check if a track stopped early because its stream or voice connection failed"""
+    source = current['source']
+    if error is None and not source.ended and voice_client.is_connected():
+        return False  # Stopped on purpose (skip, profile change...)
+    duration = current['track'].duration
+    if not duration:
+        # Without a duration a clean end of stream is the normal end of the track
+        return error is not None or not voice_client.is_connected()
+    return duration - source.position > RESUME_MIN_REMAINING
+
+
+async def resume_interrupted(guild_id, voice_client, channel, current):
+    """Queue an interrupted track again at its last position and return the voice client to use"""
+    track, source = current['track'], current['source']
+    if source.position - source.start_offset >= RESUME_PROGRESS_RESET:
+        track.resume_attempts = 0
+    track.resume_attempts += 1
+    if track.resume_attempts > RESUME_ATTEMPTS:
+        playback_failures.inc()
+        message_scheduler.send(channel, f"⚠️ Lost the stream of **{track.title}** too many times. Skipping.")
+        return voice_client
+
+    print(f"Resuming {track.title} in guild {guild_id} at {format_time_duration(source.position)} "
+          f"(attempt {track.resume_attempts}/{RESUME_ATTEMPTS})")
+    playback_resumes.inc()
+    track.resume_at = source.position
+    if not source.from_cache:
+        # The signed URL has probably expired - get a fresh one
+        track.url = None
+        await bot.loop.run_in_executor(None, stream_cache.invalidate, track.id)
+    song_queues.setdefault(guild_id, SongQueue()).appendleft(track)
+
+    if not voice_client.is_connected():
+        voice_client = await wait_for_voice(guild_id, voice_client)
+    return voice_client
+
+
+async def wait_for_voice(guild_id, voice_client):
+    """Wait for a dropped voice connection to come back, reconnecting it ourselves if needed"""
+    deadline = time.monotonic() + VOICE_RECONNECT_TIMEOUT
+    while time.monotonic() < deadline:
+        if voice_clients.get(guild_id) is not voice_client:
+            return None  # Left or kicked in the meantime
+        if voice_client.is_connected():
+            return voice_client
+        await asyncio.sleep(0.5)
+
+    # discord.py gave up - join the channel again with a fresh connection
+    voice_channel = voice_client.channel
+    reconnecting_guilds.add(guild_id)
+    try:
+        await voice_client.disconnect(force=True)
+        new_client = await voice_channel.connect()
+    except Exception as e:
+        print(f"⚠️ Could not reconnect to voice in guild {guild_id}: {e}")
+        voice_clients.pop(guild_id, None)
+        release_playback_state(guild_id)
+        return None
+    finally:
+        reconnecting_guilds.discard(guild_id)
+    voice_clients[guild_id] = new_client
+    print(f"Reconnected to voice in guild {guild_id}")
+    return new_client
+
+
+def release_playback_state(guild_id):
+    """Forget the playback state and queue of a guild and stop any prefetched ffmpeg"""
+    song_queues.pop(guild_id, None)
+    now_playing.pop(guild_id, None)
+    track_ended_at.pop(guild_id, None)
+    text_channels.pop(guild_id, None)
+    first_audio_requests.pop(guild_id, None)
+    if state_store:
+        state_store.forget(guild_id)
+    task = prefetch_tasks.pop(guild_id, None)
+    if task and not task.done():
+        task.cancel()
+    discard_prefetch(guild_id)
+    idle_tracker.cancel(guild_id)
+    message_scheduler.forget(guild_id)
+    player = guild_players.pop(guild_id, None)
+    if player:
+        player.post('stop')
+
+
+# ⏲️ Idle timers - armed by playback and voice state events instead of polling
+class IdleTracker:
+    """Keeps one deadline per guild in a heap and sleeps until the earliest one"""
+
+    def __init__(self):
+        self.deadlines = {}  # guild_id -> (deadline, reason)
+        self.heap = []  # (deadline, guild_id) - entries no longer in `deadlines` are skipped
+        self.wakeup = None  # Created by run(), on the bot's event loop
+
+    def arm(self, guild_id, timeout, reason):
+        """Start a guild's timer, unless one for the same reason is already running"""
+        current = self.deadlines.get(guild_id)
+        if current and current[1] == reason:
+            return
+        deadline = time.monotonic() + timeout
+        self.deadlines[guild_id] = (deadline, reason)
+        heapq.heappush(self.heap, (deadline, guild_id))
+        if self.wakeup and self.heap[0][0] == deadline:
+            self.wakeup.set()
+
+    def cancel(self, guild_id):
+        """Stop a guild's timer"""
+        self.deadlines.pop(guild_id, None)
+
+    async def run(self):
+        """Fire expired timers, sleeping until the next deadline or a new earlier one"""
+        self.wakeup = asyncio.Event()
+        while True:
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                deadline, guild_id = heapq.heappop(self.heap)
+                current = self.deadlines.get(guild_id)
+                if current and current[0] == deadline:
+                    del self.deadlines[guild_id]
+                    bot.loop.create_task(disconnect_idle(guild_id, current[1]))
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - now if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+idle_tracker = IdleTracker()
+
+
+def idle_timeout_for(guild_id):
+    """Seconds a guild may stay connected without playing anything"""
+    return get_guild_setting(guild_id, 'idle_timeout', IDLE_TIMEOUT)
+
+
+def update_idle_timer(guild_id):
+    """Arm or cancel a guild's idle timer to match what the bot is doing there now"""
+    voice_client = voice_clients.get(guild_id)
+    if voice_client is None:
+        idle_tracker.cancel(guild_id)
         return
-        
-    # Print available info keys
-    print(f"Info keys: {list(info_dict.keys())}")
-    
-    # Print all available formats
-    if 'formats' in info_dict:
-        print("\nALL AVAILABLE FORMATS:")
-        for fmt in info_dict['formats']:
-            print(f"Format ID: {fmt.get('format_id')} - Ext: {fmt.get('ext')} - "
-                  f"Audio: {fmt.get('acodec')} - Video: {fmt.get('vcodec')} - "
-                  f"ABR: {fmt.get('abr')} - TBR: {fmt.get('tbr')}")
-    
-    # Debug: Look for best format - what yt-dlp actually selected
-    if 'requested_formats' in info_dict:
-        print("\nSELECTED FORMATS:")
-        for fmt in info_dict['requested_formats']:
-            format_id = fmt.get('format_id', 'unknown')
-            ext = fmt.get('ext', 'unknown')
-            acodec = fmt.get('acodec', 'none')
-            abr = fmt.get('abr', fmt.get('tbr', 'unknown'))
-            
-            print(f"Selected format: {format_id} ({ext})")
-            print(f"Audio codec: {acodec}, Bitrate: {abr} kbps")
-    elif 'format_id' in info_dict:
-        # Single format selected
-        print("\nSINGLE SELECTED FORMAT:")
-        print(f"Format ID: {info_dict.get('format_id')} - Ext: {info_dict.get('ext')}")
-        print(f"Audio codec: {info_dict.get('acodec')}, Bitrate: {info_dict.get('abr', info_dict.get('tbr', 'unknown'))} kbps")
+    channel = getattr(voice_client, 'channel', None)
+    if channel is not None and not any(not member.bot for member in channel.members):
+        idle_tracker.arm(guild_id, ALONE_TIMEOUT, 'alone')
+    elif voice_client.is_playing():
+        idle_tracker.cancel(guild_id)
     else:
-        print("No format information available in the info")
-        # If we're here but have a URL, we probably have a direct stream URL
-        if 'url' in info_dict:
-            print(f"Direct URL found: {info_dict['url'][:50]}... (truncated)")
-            if 'ext' in info_dict:
-                print(f"Extension: {info_dict.get('ext')}")
+        idle_tracker.arm(guild_id, idle_timeout_for(guild_id), 'idle')
+
+
+async def disconnect_idle(guild_id, reason):
+    """Leave a voice channel whose idle timer ran out and free everything the guild held"""
+    voice_client = voice_clients.get(guild_id)
+    if voice_client is None:
+        return
+    if reason == 'idle' and voice_client.is_playing():
+        return  # Playback started again just as the timer fired
+    channel = text_channels.get(guild_id)
+    print(f"Voice client in guild {guild_id} {reason} for "
+          f"{format_time_duration(ALONE_TIMEOUT if reason == 'alone' else idle_timeout_for(guild_id))} - disconnecting")
+    try:
+        await voice_client.disconnect()
+    except Exception as e:
+        print(f"Error disconnecting idle client in guild {guild_id}: {e}")
+    voice_clients.pop(guild_id, None)
+    release_playback_state(guild_id)
+    if channel:
+        message = ("👋 Left the voice channel because everyone else left." if reason == 'alone'
+                   else f"👋 Left the voice channel after {format_time_duration(idle_timeout_for(guild_id))} without music.")
+        message_scheduler.send(channel, message)
+
+
+# 💾 Durable queue and playback state
+class StateStore:
+    """Persists per-guild queues and playback positions to SQLite in batched writes"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.saved_queues = {}  # guild_id -> queue version last written
+        self.saved_states = {}  # guild_id -> guild_state row last written
+        self.forgotten = set()
+        db = get_db()
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS guild_state ('
+            'guild_id INTEGER PRIMARY KEY, voice_channel_id INTEGER, text_channel_id INTEGER, '
+            'current_track TEXT, position REAL, updated_at REAL)')
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS queue_tracks ('
+            'guild_id INTEGER, position INTEGER, track TEXT, PRIMARY KEY (guild_id, position))')
+
+    def forget(self, guild_id):
+        """Drop the saved state of a guild on the next flush"""
+        self.forgotten.add(guild_id)
+        self.saved_queues.pop(guild_id, None)
+        self.saved_states.pop(guild_id, None)
+
+    def snapshot(self):
+        """Collect everything that changed since the last flush (runs on the event loop)"""
+        states = []
+        queues = []
+        for guild_id, voice_client in list(voice_clients.items()):
+            if not voice_client.is_connected():
+                continue
+            self.forgotten.discard(guild_id)
+            current = now_playing.get(guild_id)
+            channel = text_channels.get(guild_id)
+            state = (
+                guild_id,
+                voice_client.channel.id,
+                channel.id if channel else None,
+                json.dumps(track_to_dict(current['track'])) if current else None,
+                round(current['source'].position, 1) if current else 0,
+            )
+            if self.saved_states.get(guild_id) != state:
+                states.append(state)
+
+            queue = song_queues.get(guild_id)
+            version = queue.version if queue is not None else None
+            if self.saved_queues.get(guild_id) != version:
+                # Only a shallow copy here - serializing a long queue is left to the executor
+                queues.append((guild_id, version, list(queue or ())))
+        forgotten = list(self.forgotten)
+        self.forgotten.clear()
+        return states, queues, forgotten
+
+    def write(self, states, queues, forgotten):
+        """Serialize the queues of a snapshot and write it in a single transaction (blocking)"""
+        db = get_db()
+        with db.lock:
+            conn = db.conn
+            now = time.time()
+            for guild_id in forgotten:
+                conn.execute('DELETE FROM guild_state WHERE guild_id = ?', (guild_id,))
+                conn.execute('DELETE FROM queue_tracks WHERE guild_id = ?', (guild_id,))
+            conn.executemany('INSERT OR REPLACE INTO guild_state VALUES (?, ?, ?, ?, ?, ?)',
+                             [state + (now,) for state in states])
+            for guild_id, _, tracks in queues:
+                conn.execute('DELETE FROM queue_tracks WHERE guild_id = ?', (guild_id,))
+                conn.executemany('INSERT INTO queue_tracks VALUES (?, ?, ?)',
+                                 [(guild_id, position, json.dumps(track_to_dict(track)))
+                                  for position, track in enumerate(tracks)])
+            conn.commit()
+
+    async def flush(self):
+        """Write pending changes without blocking the event loop"""
+        states, queues, forgotten = self.snapshot()
+        if not (states or queues or forgotten):
+            return
+        try:
+            await bot.loop.run_in_executor(None, self.write, states, queues, forgotten)
+        except Exception as e:
+            print(f"Error saving playback state: {e}")
+            return
+        for state in states:
+            self.saved_states[state[0]] = state
+        for guild_id, version, _ in queues:
+            self.saved_queues[guild_id] = version
+
+    async def run(self):
+        """Flush state every few seconds"""
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def load(self):
+        """Read every saved guild (blocking)"""
+        db = get_db()
+        saved = {}
+        for guild_id, voice_channel_id, text_channel_id, current, position, _ in db.execute(
+                'SELECT * FROM guild_state'):
+            saved[guild_id] = {
+                'voice_channel_id': voice_channel_id,
+                'text_channel_id': text_channel_id,
+                'current': track_from_dict(json.loads(current)) if current else None,
+                'position': position or 0,
+                'tracks': [],
+            }
+        for guild_id, _, track in db.execute(
+                'SELECT guild_id, position, track FROM queue_tracks ORDER BY guild_id, position'):
+            if guild_id in saved:
+                saved[guild_id]['tracks'].append(track_from_dict(json.loads(track)))
+        return saved
+
+
+def track_to_dict(track):
+    """Serialize a track without its short-lived stream URL"""
+    return {'id': track.id, 'title': track.title,
+            'webpage_url': track.webpage_url, 'duration': track.duration}
+
+
+def track_from_dict(data):
+    """Rebuild an unresolved track from its saved form"""
+    return Track(data['id'], data['title'],
+                 webpage_url=data.get('webpage_url'), duration=data.get('duration'))
+
+
+state_store = StateStore(STATE_FLUSH_INTERVAL) if PERSIST_STATE else None
+
+
+def owns_guild(guild_id):
+    """Check if a guild belongs to one of the shards run by this process"""
+    if not bot.shard_count or bot.shard_ids is None:
+        return True
+    return (guild_id >> 22) % bot.shard_count in bot.shard_ids
+
+
+async def restore_state():
+    """Rejoin voice channels and resume the queues saved before the last shutdown"""
+    saved = await bot.loop.run_in_executor(None, state_store.load)
+    for guild_id, state in saved.items():
+        if not owns_guild(guild_id):
+            continue  # Another shard process resumes this one
+        guild = bot.get_guild(guild_id)
+        voice_channel = guild.get_channel(state['voice_channel_id']) if guild else None
+        queue = SongQueue(state['tracks'])
+        if state['current']:
+            # Pick the interrupted track up where it stopped
+            state['current'].resume_at = state['position']
+            queue.appendleft(state['current'])
+        if voice_channel is None or not queue:
+            state_store.forget(guild_id)
+            continue
+
+        try:
+            voice_client = await voice_channel.connect()
+        except Exception as e:
+            print(f"Could not rejoin voice channel in guild {guild_id}: {e}")
+            state_store.forget(guild_id)
+            continue
+
+        voice_clients[guild_id] = voice_client
+        update_idle_timer(guild_id)
+        channel = guild.get_channel(state['text_channel_id']) or voice_channel
+        print(f"Restored {len(queue)} songs in guild {guild.name} ({guild_id})")
+
+        # Only the head of the queue is resolved now, the rest just in time
+        get_player(guild_id).post('enqueue', tracks=list(queue), channel=channel)
 
 
 # 🔍 Slash command to search YouTube and play the first result
 @bot.tree.command(
     name="search",
     description="Search YouTube for a song and play the first result")
+@app_commands.describe(song_title="What to search for - pick a suggestion to skip the search")
 async def search_song(interaction: discord.Interaction, song_title: str):
   await interaction.response.defer()
-  search_url = f"ytsearch:{song_title}"
   loop = asyncio.get_event_loop()
+
+  # A picked suggestion or a query searched before goes straight to the video
+  suggestion = SUGGESTION_PATTERN.match(song_title)
+  video_id = suggestion.group(1) if suggestion else search_index.lookup(song_title)
+  if video_id:
+    search_url = f"https://www.youtube.com/watch?v={video_id}"
+  else:
+    search_url = f"ytsearch:{song_title}"
   
   try:
     # Use the utility function to extract audio info
-    data = await extract_audio_info(search_url, loop)
+    data = await extract_audio_info(search_url, loop, interaction.guild.id)
     
     # Process and queue the song
     if data and 'url' in data:
-      await add_song_to_queue(interaction, data['url'], data['title'])
+      if not video_id:
+        loop.run_in_executor(None, search_index.remember_search, song_title, data.get('id'), data.get('title'))
+      await add_song_to_queue(interaction, data)
     else:
-      await interaction.followup.send(f"No results found for '{song_title}'.")
+      reason = describe_extraction_failure(search_url)
+      if reason:
+        await interaction.followup.send(f"⚠️ {reason}")
+      else:
+        await interaction.followup.send(f"No results found for '{song_title}'.")
       
   except Exception as e:
     print(f"Error in search_song: {e}")
     await interaction.followup.send(f"Error searching for '{song_title}': {str(e)}")
 
 
+@search_song.autocomplete('song_title')
+async def search_autocomplete(interaction: discord.Interaction, current: str):
+  # Answered from memory only, well within Discord's 3 second limit
+  if SUGGESTION_PATTERN.match(current):
+    return []
+  return [
+      app_commands.Choice(name=(title or video_id)[:100], value=f"yt:{video_id}")
+      for video_id, title in search_index.suggest(current)
+  ]
+
+
 # ▶️ Slash command to play a song from a URL
 @bot.tree.command(name="play",
                   description="Play a song from a direct YouTube link")
@@ -281,13 +3334,17 @@ async def play_song(interaction: discord.Interaction, song_url: str):
   
   try:
     # Use the utility function to extract audio info
-    data = await extract_audio_info(song_url, loop)
+    data = await extract_audio_info(song_url, loop, interaction.guild.id)
     
     # Process and queue the song
     if data and 'url' in data:
-      await add_song_to_queue(interaction, data['url'], data['title'])
+      await add_song_to_queue(interaction, data)
     else:
-      await interaction.followup.send("⚠️ Could not extract audio from the provided URL.")
+      reason = describe_extraction_failure(song_url)
+      if reason:
+        await interaction.followup.send(f"⚠️ {reason}")
+      else:
+        await interaction.followup.send("⚠️ Could not extract audio from the provided URL.")
       
   except Exception as e:
     print(f"Error in play_song: {e}")
@@ -295,7 +3352,7 @@ async def play_song(interaction: discord.Interaction, song_url: str):
 
 
 # ➕ Function to add a song to the queue
-async def add_song_to_queue(interaction, song_url, title):
+async def add_song_to_queue(interaction, data):
   guild_id = interaction.guild.id
   
   # Get or create a voice client
@@ -304,19 +3361,12 @@ async def add_song_to_queue(interaction, song_url, title):
     await interaction.followup.send("⚠️ You need to join a voice channel first.")
     return
 
-  # Initialize queue if needed
-  if guild_id not in song_queues:
-    song_queues[guild_id] = []
-
-  # Add song to queue
-  song_queues[guild_id].append({
-    'url': song_url, 
-    'title': title
-  })
-
-  # Start playing if not already playing
+  # The guild's player queues the song and starts it if nothing is playing yet
+  track = make_track(data)
+  title = track.title
   if not voice_client.is_playing() and not voice_client.is_paused():
-    await play_next_song(guild_id, voice_client, interaction.channel)
+    first_audio_requests.setdefault(guild_id, interaction.created_at)
+  get_player(guild_id).post('enqueue', tracks=[track], channel=interaction.channel)
 
   embed = discord.Embed(title=f"🎵 Added to Queue: {title}",
                         description="Playing from YouTube",
@@ -330,6 +3380,7 @@ async def pause_song(interaction: discord.Interaction):
   voice_client = voice_clients.get(interaction.guild.id)
   if voice_client and voice_client.is_playing():
     voice_client.pause()
+    update_idle_timer(interaction.guild.id)
     await interaction.response.send_message("⏸️ Song paused.")
   else:
     await interaction.response.send_message("⚠️ No song is currently playing.")
@@ -341,6 +3392,7 @@ async def resume_song(interaction: discord.Interaction):
   voice_client = voice_clients.get(interaction.guild.id)
   if voice_client and voice_client.is_paused():
     voice_client.resume()
+    update_idle_timer(interaction.guild.id)
     await interaction.response.send_message("▶️ Song resumed.")
   else:
     await interaction.response.send_message("⚠️ No song is currently paused.")
@@ -350,8 +3402,7 @@ async def resume_song(interaction: discord.Interaction):
 async def skip_song(interaction: discord.Interaction):
   voice_client = voice_clients.get(interaction.guild.id)
   if voice_client and voice_client.is_playing():
-    voice_client.stop(
-    )  # ✅ Stop the current song (next song will be handled by `after`)
+    get_player(interaction.guild.id).post('skip')  # ✅ The player stops it and starts the next song
     await interaction.response.send_message("⏩ Skipped the current song.")
   else:
     await interaction.response.send_message("⚠️ No song is currently playing.")
@@ -368,17 +3419,114 @@ async def leave_voice(interaction: discord.Interaction):
     guild_id = interaction.guild.id
     if guild_id in voice_clients:
         del voice_clients[guild_id]
-    if guild_id in song_queues:
-        del song_queues[guild_id]
+    release_playback_state(guild_id)
     await interaction.response.send_message(
         "🔌 Disconnected from voice channel.")
   else:
     await interaction.response.send_message("⚠️ I'm not in a voice channel.")
 
 
+# Queue pages - only the visible slice of the queue is ever rendered
+QUEUE_PAGE_SIZE = 10
+QUEUE_VIEW_TIMEOUT = 300  # Seconds the page buttons keep working
+
+
+def format_track_length(seconds):
+    """Format a track length as m:ss or h:mm:ss"""
+    if not seconds:
+        return "?:??"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+class QueueView(discord.ui.View):
+    """Previous/next/jump buttons that page through a guild's queue"""
+
+    def __init__(self, guild_id, page=0):
+        super().__init__(timeout=QUEUE_VIEW_TIMEOUT)
+        self.guild_id = guild_id
+        self.page = page
+        self.message = None
+
+    def render(self):
+        """Build the embed for the current page and update the buttons"""
+        queue = song_queues.get(self.guild_id) or SongQueue()
+        pages = max(1, math.ceil(len(queue) / QUEUE_PAGE_SIZE))
+        self.page = max(0, min(self.page, pages - 1))
+        start = self.page * QUEUE_PAGE_SIZE
+        lines = []
+        for position, track in enumerate(queue.slice(start, start + QUEUE_PAGE_SIZE), start + 1):
+            title = track.title if len(track.title) <= 80 else track.title[:79] + "…"
+            lines.append(f"{position}. {title} ({format_track_length(track.duration)})")
+
+        embed = discord.Embed(title="🎵 Current Queue",
+                              description="\n".join(lines) or "🎶 The queue is currently empty.",
+                              color=discord.Color.blue())
+        current = now_playing.get(self.guild_id)
+        if current:
+            embed.add_field(name="Now playing", value=current['track'].title[:1024], inline=False)
+        total = format_time_duration(queue.total_duration)
+        if queue.unknown_durations:
+            total += f" + {queue.unknown_durations} of unknown length"
+        embed.set_footer(text=f"Page {self.page + 1}/{pages} • {len(queue)} songs • {total}")
+
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= pages - 1
+        self.jump_to_page.disabled = pages == 1
+        return embed
+
+    async def show(self, interaction):
+        """Re-render the page in place of the message the buttons belong to"""
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    @discord.ui.button(label="Previous", emoji="◀️", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page -= 1
+        await self.show(interaction)
+
+    @discord.ui.button(label="Next", emoji="▶️", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        await self.show(interaction)
+
+    @discord.ui.button(label="Jump to page", emoji="🔢", style=discord.ButtonStyle.primary)
+    async def jump_to_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.send_modal(JumpToPageModal(self))
+
+    async def on_timeout(self):
+        for item in self.children:
+            item.disabled = True
+        if self.message:
+            # Cosmetic, so it waits its turn behind the channel's messages
+            message_scheduler.edit(self.message, view=self)
+
+
+class JumpToPageModal(discord.ui.Modal, title="Jump to page"):
+    """Asks for a page number and shows that page of the queue"""
+
+    page_number = discord.ui.TextInput(label="Page", placeholder="e.g. 12", max_length=6)
+
+    def __init__(self, queue_view):
+        super().__init__()
+        self.queue_view = queue_view
+
+    async def on_submit(self, interaction: discord.Interaction):
+        try:
+            page = int(self.page_number.value)
+        except ValueError:
+            await interaction.response.send_message("⚠️ Please enter a page number.", ephemeral=True)
+            return
+        self.queue_view.page = page - 1
+        await self.queue_view.show(interaction)
+
+
 # 📜 Slash command to show the current song queue
 @bot.tree.command(name="queue", description="Show the current song queue")
-async def show_queue(interaction: discord.Interaction):
+@app_commands.describe(page="Page to start on (default: 1)")
+async def show_queue(interaction: discord.Interaction, page: Range[int, 1, 100000] = 1):
   guild_id = interaction.guild.id
   voice_client = voice_clients.get(guild_id)
 
@@ -392,15 +3540,110 @@ async def show_queue(interaction: discord.Interaction):
     await interaction.response.send_message("🎶 The queue is currently empty.")
     return
 
-  # Format the queue with just song titles
-  queue_list = "\n".join([
-      f"{index + 1}. {song['title']}"
-      for index, song in enumerate(song_queues[guild_id])
-  ])
+  # Only the requested page is rendered, however long the queue is
+  view = QueueView(guild_id, page - 1)
+  await interaction.response.send_message(embed=view.render(), view=view)
+  view.message = await interaction.original_response()
+
+
+# 🎚️ Slash command to pick the encoding profile for this server
+@bot.tree.command(name="profile", description="Choose the audio encoding profile for this server")
+@app_commands.describe(profile="low-cpu saves CPU, quality sounds best (capped at the channel bitrate)")
+@app_commands.choices(profile=[
+    app_commands.Choice(name=name, value=name) for name in ENCODE_PROFILES
+])
+async def set_profile(interaction: discord.Interaction, profile: app_commands.Choice[str]):
+  guild_id = interaction.guild.id
+  await set_guild_setting(guild_id, 'encode_profile', profile.value)
+  bitrate, complexity = encoding_for(guild_id)
+  retarget_encoding(guild_id)
+  await interaction.response.send_message(
+      f"🎚️ Encoding profile set to **{profile.value}** ({bitrate} kbps, complexity {complexity}).")
+
+
+# 📡 Slash command to share one audio pipeline per track with other servers
+@bot.tree.command(name="broadcast", description="Join other servers playing the same song live instead of starting it over")
+@app_commands.describe(mode="on: join a song live if another server is playing it, off: always start from the beginning")
+@app_commands.choices(mode=[
+    app_commands.Choice(name="on", value="on"),
+    app_commands.Choice(name="off", value="off"),
+])
+async def set_broadcast(interaction: discord.Interaction, mode: app_commands.Choice[str]):
+  guild_id = interaction.guild.id
+  await set_guild_setting(guild_id, 'broadcast', mode.value == 'on')
+  discard_prefetch(guild_id)
+  if mode.value == 'on':
+    await interaction.response.send_message("📡 Broadcast mode on - songs other servers are playing are joined live.")
+  else:
+    await interaction.response.send_message("📡 Broadcast mode off - every song starts from the beginning.")
+
+
+# ⏲️ Slash command to set how long the bot stays in voice without playing
+@bot.tree.command(name="idle", description="Set how long the bot stays in voice without playing")
+@app_commands.describe(minutes="Minutes without playback before the bot leaves")
+async def set_idle_timeout(interaction: discord.Interaction, minutes: Range[int, 1, 1440]):
+  guild_id = interaction.guild.id
+  await set_guild_setting(guild_id, 'idle_timeout', minutes * 60)
+  # Restart a running idle timer with the new timeout
+  idle_tracker.cancel(guild_id)
+  update_idle_timer(guild_id)
+  await interaction.response.send_message(f"⏲️ I'll leave after {minutes} minutes without playing.")
+
+
+# 📊 Slash command to show playback and cache statistics
+@bot.tree.command(name="status", description="Show playback and cache statistics")
+async def show_status(interaction: discord.Interaction):
+  guild_id = interaction.guild.id
+  embed = discord.Embed(title="📊 Bot Status", color=discord.Color.blue())
+  embed.add_field(name="Voice connections", value=str(len(voice_clients)))
+  embed.add_field(name="Stream cache",
+                  value=f"{len(stream_cache.entries)} entries "
+                        f"({stream_cache.hits} hits / {stream_cache.misses} misses)")
+  embed.add_field(name=f"Extractions ({extraction_scheduler.backend})",
+                  value=f"{extraction_scheduler.running}/{extraction_scheduler.limit} running "
+                        f"(max {extraction_scheduler.concurrency}), {extraction_scheduler.pending} waiting")
+  breaker = f"Circuit breaker {extraction_breaker.status()}"
+  if extraction_breaker.last_error and extraction_breaker.state != 'closed':
+    breaker += f" - last error: {extraction_breaker.last_error}"
+  embed.add_field(name="Extraction health",
+                  value=f"{breaker}, {len(unavailable_videos.entries)} unavailable videos cached "
+                        f"({unavailable_videos.hits} hits)", inline=False)
+
+  current = now_playing.get(guild_id)
+  if current:
+    source = current['source']
+    if source.broadcast:
+      mode = f"Broadcast shared by {len(source.broadcast.listeners)} servers"
+    elif source.from_cache:
+      mode = "Local audio cache"
+    elif source.passthrough:
+      mode = "Opus passthrough"
+    else:
+      mode = f"Transcoding at {source.encoding[0]} kbps"
+    embed.add_field(name="Now playing", value=f"{current['track'].title} ({mode})", inline=False)
+    read_ahead = source.read_ahead or (source.broadcast and source.broadcast.upstream.read_ahead)
+    if read_ahead:
+      embed.add_field(name="Read-ahead buffer",
+                      value=f"{read_ahead.filled}/{read_ahead.depth} frames, "
+                            f"average {read_ahead.average_fill:.0f}, {read_ahead.underruns} underruns")
+
+  embed.add_field(name="Search cache",
+                  value=f"{len(search_index.results)} queries, {len(search_index.videos)} songs indexed "
+                        f"({search_index.hits} hits / {search_index.misses} misses)")
+
+  if audio_cache:
+    embed.add_field(name="Audio cache",
+                    value=f"{len(audio_cache.files)} files, "
+                          f"{audio_cache.total_bytes / (1024 * 1024):.0f}/{AUDIO_CACHE_MAX_MB} MB")
+
+  gaps = track_gaps.get(guild_id)
+  if gaps:
+    average = sum(gaps) / len(gaps)
+    embed.add_field(name="Gap between tracks",
+                    value=f"last {gaps[-1] * 1000:.0f} ms, average {average * 1000:.0f} ms "
+                          f"over {len(gaps)} tracks",
+                    inline=False)
 
-  embed = discord.Embed(title="🎵 Current Queue",
-                        description=queue_list,
-                        color=discord.Color.blue())
   await interaction.response.send_message(embed=embed)
 
 
@@ -430,13 +3673,14 @@ async def clear_queue(interaction: discord.Interaction):
     await interaction.response.send_message("⚠️ The queue is already empty.")
     return
   
-  # Store the queue length for the message
-  queue_length = len(song_queues[guild_id])
-  
-  # Clear the queue
-  song_queues[guild_id] = []
+  # The player clears it between two of its own steps (it may be starting a track right now)
+  await interaction.response.defer()
+  queue_length = await get_player(guild_id).request('clear')
+  if queue_length == 0:
+    await interaction.followup.send("⚠️ The queue is already empty.")
+    return
   
-  await interaction.response.send_message(f"🗑️ Cleared {queue_length} songs from the queue.")
+  await interaction.followup.send(f"🗑️ Cleared {queue_length} songs from the queue.")
 
 
 # 🗑️ Slash command to remove songs from the queue
@@ -447,7 +3691,7 @@ async def clear_queue(interaction: discord.Interaction):
 )
 async def remove_from_queue(
     interaction: discord.Interaction, 
-    index: Range[int, 1, 1000],
+    index: Range[int, 1, 100000],
     length: Range[int, 1, 100] = 1
 ):
     guild_id = interaction.guild.id
@@ -457,28 +3701,19 @@ async def remove_from_queue(
         await interaction.response.send_message("⚠️ The queue is empty.")
         return
     
-    # Convert from 1-based (user) to 0-based (internal) indexing
-    zero_index = index - 1
-    queue_length = len(song_queues[guild_id])
+    # Convert from 1-based (user) to 0-based (internal) indexing - the player checks
+    # the bounds against the queue as it is when the removal is applied
+    await interaction.response.defer()
+    removed, queue_length = await get_player(guild_id).request('remove', index=index - 1, length=length)
     
     # Check if index is valid
-    if zero_index >= queue_length:
-        await interaction.response.send_message(f"⚠️ Invalid index: {index}. The queue only has {queue_length} songs.")
+    if not removed:
+        await interaction.followup.send(f"⚠️ Invalid index: {index}. The queue only has {queue_length} songs.")
         return
     
-    # Adjust length if it would exceed the queue bounds
-    if zero_index + length > queue_length:
-        actual_length = queue_length - zero_index
-    else:
-        actual_length = length
-    
-    # Get titles of songs being removed for the message
-    removed_songs = []
-    for i in range(zero_index, zero_index + actual_length):
-        removed_songs.append(song_queues[guild_id][i]['title'])
-    
-    # Remove songs from the queue
-    del song_queues[guild_id][zero_index:zero_index + actual_length]
+    # Keep the titles for the message
+    removed_songs = [track.title for track in removed]
+    actual_length = len(removed_songs)
     
     # Prepare response message
     if actual_length == 1:
@@ -493,7 +3728,50 @@ async def remove_from_queue(
                 response += f"...and {remaining} more."
                 break
     
-    await interaction.response.send_message(response)
+    await interaction.followup.send(response)
+
+
+# 🔀 Slash command to shuffle the song queue
+@bot.tree.command(name="shuffle", description="Shuffle the current song queue")
+async def shuffle_queue(interaction: discord.Interaction):
+  guild_id = interaction.guild.id
+  
+  if guild_id not in song_queues or len(song_queues[guild_id]) == 0:
+    await interaction.response.send_message("⚠️ The queue is empty.")
+    return
+  
+  await interaction.response.defer()
+  shuffled = await get_player(guild_id).request('shuffle')
+  if shuffled == 0:
+    await interaction.followup.send("⚠️ The queue is empty.")
+    return
+  await interaction.followup.send(f"🔀 Shuffled {shuffled} songs.")
+
+
+# ↕️ Slash command to move a song within the queue
+@bot.tree.command(name="move", description="Move a song to a different position in the queue")
+@app_commands.describe(
+    index="Current position of the song (starting from 1)",
+    position="New position of the song (starting from 1)"
+)
+async def move_in_queue(
+    interaction: discord.Interaction,
+    index: Range[int, 1, 100000],
+    position: Range[int, 1, 100000]
+):
+  guild_id = interaction.guild.id
+  
+  if guild_id not in song_queues or len(song_queues[guild_id]) == 0:
+    await interaction.response.send_message("⚠️ The queue is empty.")
+    return
+  
+  await interaction.response.defer()
+  track, position, queue_length = await get_player(guild_id).request('move', index=index - 1, position=position - 1)
+  if track is None:
+    await interaction.followup.send(f"⚠️ Invalid index: {index}. The queue only has {queue_length} songs.")
+    return
+  
+  await interaction.followup.send(f"↕️ Moved **{track.title}** to position {position + 1}.")
 
 
 # 🎵 Slash command to add a YouTube playlist to the queue
@@ -502,41 +3780,38 @@ async def remove_from_queue(
     description="Add songs from a YouTube playlist to the queue")
 @app_commands.describe(
     playlist_url="The URL of the YouTube playlist",
-    limit="Maximum number of songs to add (optional, default: all songs)"
+    limit="Maximum number of songs to add (optional, default: all songs)",
+    skip_duplicates="Skip songs that are already in the queue (default: no)"
 )
 async def add_playlist(
     interaction: discord.Interaction, 
     playlist_url: str,
-    limit: int = None
+    limit: int = None,
+    skip_duplicates: bool = False
 ):
   await interaction.response.defer()
-  loop = asyncio.get_event_loop()
   
   try:
     # Extract playlist info
-    def extract_playlist_info():
-      # Configure ytdl to extract playlist
-      playlist_options = yt_dl_options.copy()
-      playlist_options['noplaylist'] = False  # Enable playlist processing
-      playlist_options['extract_flat'] = 'in_playlist'  # Don't extract individual videos yet
-      playlist_ytdl = yt_dlp.YoutubeDL(playlist_options)
-      
-      # Get playlist info
-      playlist_info = playlist_ytdl.extract_info(playlist_url, download=False)
-      if os.getenv('DEBUG'):
-          print(f"Playlist info keys: {list(playlist_info.keys())}")
-      # Don't try to print format info for the playlist itself - it won't have any
-      
-      return playlist_info
-    
-    playlist_data = await loop.run_in_executor(None, extract_playlist_info)
+    playlist_data = await run_extraction_job(interaction.guild.id, run_playlist_extraction, playlist_url)
     
     # Check if it's a valid playlist
-    if not playlist_data or 'entries' not in playlist_data:
+    if not playlist_data or playlist_data['entries'] is None:
       await interaction.followup.send("⚠️ Could not extract playlist information or invalid URL.")
       return
     
-    entries = list(playlist_data['entries'])
+    # Unavailable videos show up as entries without an ID
+    entries = [entry for entry in playlist_data['entries'] if entry and entry.get('id')]
+
+    # Leave out videos known to be unavailable (private and deleted ones are listed under a placeholder title)
+    playable = []
+    for entry in entries:
+      if entry.get('title') in ('[Private video]', '[Deleted video]'):
+        unavailable_videos.put(entry['id'], entry['title'].strip('[]'))
+      elif not unavailable_videos.get(entry['id'], count=False):
+        playable.append(entry)
+    unavailable_songs = len(entries) - len(playable)
+    entries = playable
     total_songs = len(entries)
     
     if total_songs == 0:
@@ -559,107 +3834,67 @@ async def add_playlist(
       await interaction.followup.send("⚠️ You need to join a voice channel first.")
       return
     
-    # Send initial progress message that we'll update
-    progress_message = await interaction.followup.send("⏳ Progress: 0/" + str(len(entries)) + " songs added to the queue...")
-    
-    # Process songs in batches to avoid rate limiting
-    # Adjust batch size based on playlist length
-    batch_size = min(10, max(1, len(entries) // 10))  # Larger batches for larger playlists (max 10)
-    added_songs = 0
-    failed_songs = 0
-    last_update = 0
-    update_interval = max(5, len(entries) // 10)  # Update progress every ~10% or at least every 5 songs
-    
-    # Track start time to calculate ETA
-    start_time = time.time()
-    
-    for i in range(0, len(entries), batch_size):
-        # Process this batch of songs
-        current_batch = entries[i:i+batch_size]
-        batch_tasks = []
-        
-        # Create tasks for each song in the batch
-        for entry in current_batch:
-            if 'id' in entry:
-                video_url = f"https://www.youtube.com/watch?v={entry['id']}"
-                task = extract_audio_info(video_url, loop)
-                batch_tasks.append((task, entry))
-        
-        # Process all tasks in the batch concurrently
-        for task, entry in batch_tasks:
-            try:
-                song_data = await task
-                
-                if song_data and 'url' in song_data:
-                    # Add to queue with the actual audio URL
-                    title = song_data.get('title', entry.get('title', f"Song #{added_songs+1}"))
-                    
-                    # Add song to queue with metadata
-                    song_queues[guild_id].append({
-                        'url': song_data['url'], 
-                        'title': title
-                    })
-                    
-                    added_songs += 1
-                else:
-                    print(f"Could not extract audio URL for {entry.get('title', 'Unknown song')}")
-                    failed_songs += 1
-            except Exception as e:
-                print(f"Error processing playlist item: {e}")
-                failed_songs += 1
-            
-            # Check if we need to update the progress after each song
-            if added_songs - last_update >= update_interval:
-                try:
-                    # Calculate ETA if we've processed enough songs
-                    eta_string = ""
-                    if added_songs > update_interval:
-                        elapsed = time.time() - start_time
-                        songs_per_second = added_songs / elapsed
-                        remaining_songs = len(entries) - added_songs
-                        if songs_per_second > 0:
-                            eta_seconds = remaining_songs / songs_per_second
-                            eta = format_time_duration(eta_seconds)
-                            eta_string = f" (ETA: {eta})"
-                    
-                    await progress_message.edit(
-                        content=f"⏳ Progress: {added_songs}/{len(entries)} songs added to the queue...{eta_string}"
-                    )
-                    last_update = added_songs
-                    if os.getenv('DEBUG'):
-                        print(f"Updated progress message: {added_songs}/{len(entries)}")
-                except Exception as e:
-                    print(f"Error updating progress message: {e}")
-        
-        # Small delay between batches to avoid rate limiting
-        if i + batch_size < len(entries):
-            await asyncio.sleep(1)
-    
-    # Final progress update if not already at 100%
-    if added_songs != last_update:
-        try:
-            await progress_message.edit(content=f"⏳ Progress: {added_songs}/{len(entries)} songs added to the queue...")
-        except Exception as e:
-            print(f"Error updating final progress message: {e}")
-    
-    # Calculate total processing time
-    total_time = format_time_duration(time.time() - start_time)
-    
-    # Start playing if not already playing
-    if not voice_client.is_playing() and not voice_client.is_paused() and added_songs > 0:
-      await play_next_song(guild_id, voice_client, interaction.channel)
+    # Queue the flat entries right away - stream URLs are resolved just in time. The guild's
+    # player leaves out duplicates if asked and starts playing if nothing is playing yet
+    if not voice_client.is_playing() and not voice_client.is_paused():
+      first_audio_requests.setdefault(guild_id, interaction.created_at)
+    added_songs = await get_player(guild_id).request(
+        'enqueue', tracks=[make_playlist_track(entry) for entry in entries],
+        skip_duplicates=skip_duplicates, channel=interaction.channel)
     
     # Send final summary
-    if failed_songs > 0:
-      await interaction.followup.send(f"✅ Added {added_songs} songs to the queue. {failed_songs} songs could not be added. (Took {total_time})")
-    else:
-      await interaction.followup.send(f"✅ Successfully added all {added_songs} songs to the queue! (Took {total_time})")
+    summary = f"✅ Added {added_songs} songs to the queue! Each song is loaded just before it plays."
+    if unavailable_songs:
+      summary += f" Left out {unavailable_songs} unavailable videos."
+    await interaction.followup.send(summary)
       
+  except ExtractionError as e:
+    print(f"Error processing playlist: {e}")
+    await interaction.followup.send(f"⚠️ Could not load the playlist: {e if e.kind == 'blocked' else e.reason}")
   except Exception as e:
     print(f"Error processing playlist: {e}")
     await interaction.followup.send(f"⚠️ Error processing playlist: {str(e)}")
 
 
+# Summarize this process for the control channel
+def collect_status():
+    """Return a JSON-serializable snapshot of this bot process"""
+    return {
+        'pid': os.getpid(),
+        'shard_ids': sorted(bot.shards) if hasattr(bot, 'shards') else None,
+        'shard_count': bot.shard_count,
+        'guilds': len(bot.guilds),
+        'voice_clients': len(voice_clients),
+        'playing': sum(1 for vc in voice_clients.values() if vc.is_playing()),
+        'queued_tracks': sum(len(queue) for queue in song_queues.values()),
+        'latency_ms': round(bot.latency * 1000) if math.isfinite(bot.latency) else None,
+        'extractions_running': extraction_scheduler.running,
+        'extractions_waiting': extraction_scheduler.pending,
+        'extraction_limit': extraction_scheduler.limit,
+        'extraction_breaker': extraction_breaker.status(),
+        'unavailable_videos': len(unavailable_videos.entries),
+        'stream_cache_entries': len(stream_cache.entries),
+        'idle_timers': len(idle_tracker.deadlines),
+        'messages_waiting': message_scheduler.pending,
+    }
+
+
+async def handle_control_client(reader, writer):
+    """Answer one command on the local control channel"""
+    try:
+        command = (await asyncio.wait_for(reader.readline(), 5)).decode().strip()
+        if command == 'status':
+            response = collect_status()
+        else:
+            response = {'error': f"unknown command {command!r}"}
+        writer.write(json.dumps(response).encode() + b'\n')
+        await writer.drain()
+    except Exception as e:
+        print(f"Error on control channel: {e}")
+    finally:
+        writer.close()
+
+
 # Clean up disconnected voice clients
 async def cleanup_voice_clients():
     """Remove disconnected voice clients from the dictionary"""
@@ -670,60 +3905,30 @@ async def cleanup_voice_clients():
     
     for guild_id in disconnected:
         del voice_clients[guild_id]
-        # Also clean up guild queues when removing voice client
-        if guild_id in song_queues:
-            del song_queues[guild_id]
+        release_playback_state(guild_id)
         print(f"Cleaned up disconnected voice client for guild {guild_id}")
 
 
 # Periodic cleanup task
 async def periodic_cleanup():
-    """Run cleanup tasks periodically"""
-    # Time tracking for idle voice clients
-    last_activity = {}
-    MAX_IDLE_TIME = 3600  # Disconnect after 1 hour of inactivity
-    
+    """Run cache maintenance periodically (idle voice clients are handled by idle_tracker)"""
     while True:
         await asyncio.sleep(3600)  # Check every hour
         
-        current_time = time.time()
-        
-        # Clean up disconnected voice clients and their resources
+        # Safety net for disconnects that didn't come with a voice state update
         await cleanup_voice_clients()
         
-        # Clean up idle voice clients
-        for guild_id, voice_client in list(voice_clients.items()):
-            # Skip if not connected
-            if not voice_client.is_connected():
-                continue
-                
-            # Check if the voice client is idle (not playing)
-            if not voice_client.is_playing():
-                # First time we see it idle, record the time
-                if guild_id not in last_activity:
-                    last_activity[guild_id] = current_time
-                    print(f"Voice client in guild {guild_id} is now idle")
-                
-                # Check if it's been idle for too long
-                elif current_time - last_activity[guild_id] > MAX_IDLE_TIME:
-                    print(f"Voice client in guild {guild_id} idle for {format_time_duration(current_time - last_activity[guild_id])} - disconnecting")
-                    try:
-                        await voice_client.disconnect()
-                        del voice_clients[guild_id]
-                        # Also clean up guild queues
-                        if guild_id in song_queues:
-                            del song_queues[guild_id]
-                        del last_activity[guild_id]
-                    except Exception as e:
-                        print(f"Error disconnecting idle client in guild {guild_id}: {e}")
-            else:
-                # If playing, remove from idle tracking
-                if guild_id in last_activity:
-                    del last_activity[guild_id]
+        # Drop stale stream URLs and searches
+        stream_cache.prune()
+        search_index.prune()
+        unavailable_videos.prune()
         
         # Print system status
-        print(f"Periodic cleanup completed - Connected to {len(voice_clients)} guilds")
+        print(f"Periodic cleanup completed - Connected to {len(voice_clients)} guilds, "
+              f"stream cache {len(stream_cache.entries)} entries "
+              f"({stream_cache.hits} hits / {stream_cache.misses} misses)")
 
 
-# Run the bot with retry logic
-asyncio.run(start_bot())
+# Run the bot with retry logic (bot.py does the same without re-running this module in extraction workers)
+if __name__ == '__main__':
+  asyncio.run(start_bot())